@@ -1,18 +1,51 @@
 import os
+import io
+import csv
+import sys
+import re
+import gzip
+import json
+import html
+import shutil
+import hashlib
+import sqlite3
 import time
+import random
+import heapq
 import asyncio
+import logging
+import functools
+import threading
+import traceback
+import contextlib
+import contextvars
 import aiohttp
 import aiosqlite
 import secrets
 
-from fastapi import FastAPI, Request, HTTPException
-from fastapi.responses import HTMLResponse
+from types import MappingProxyType
+from typing import NamedTuple
+from collections import Counter, OrderedDict, deque
 
-from telegram import Update, InlineKeyboardMarkup, InlineKeyboardButton
+from fastapi import FastAPI, Request, HTTPException
+from fastapi.responses import HTMLResponse, JSONResponse
+
+from telegram import (
+    Update,
+    InlineKeyboardMarkup,
+    InlineKeyboardButton,
+    InputMediaAudio,
+    InputMediaDocument,
+    InputMediaPhoto,
+    InputMediaVideo,
+)
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter, TelegramError
+from telegram.request import HTTPXRequest
 from telegram.ext import (
     Application,
     CommandHandler,
     CallbackQueryHandler,
+    ChatMemberHandler,
     ContextTypes,
     MessageHandler,
     filters,
@@ -23,6 +56,29 @@ from telegram.ext import (
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 WEBHOOK_TOKEN = os.getenv("WEBHOOK_TOKEN")
 
+# Як отримувати апдейти: "webhook" (FastAPI-ендпоінт) або "polling"
+# (long polling getUpdates — за NAT, для навантажувальних тестів,
+# або коли доставка webhook деградувала)
+INGESTION_MODE = os.getenv("INGESTION_MODE", "webhook").strip().lower()
+POLL_TIMEOUT = int(os.getenv("POLL_TIMEOUT", "50"))
+POLL_LIMIT = min(100, int(os.getenv("POLL_LIMIT", "100")))
+# скільки користувачів з однієї пачки обробляються паралельно
+POLL_CONCURRENCY = int(os.getenv("POLL_CONCURRENCY", "32"))
+
+# Інший сервер Bot API (локальний telegram-bot-api або фейк для тестів),
+# напр. "http://127.0.0.1:8081/bot"
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL", "").strip()
+
+# Керована реєстрація webhook: якщо задано WEBHOOK_BASE_URL (напр.
+# "https://bot.example.com"), на старті звіряємо налаштування з getWebhookInfo
+# і викликаємо setWebhook лише коли щось змінилось. WEBHOOK_SECRET — secret_token
+# (1-256 символів A-Z a-z 0-9 _ -), який Telegram шле в заголовку кожного запиту.
+WEBHOOK_BASE_URL = os.getenv("WEBHOOK_BASE_URL", "").strip().rstrip("/")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "").strip()
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "40"))
+# WEBHOOK_DROP_PENDING=1 скидає чергу апдейтів при КОЖНОМУ старті, поки задано
+WEBHOOK_DROP_PENDING = os.getenv("WEBHOOK_DROP_PENDING", "0") == "1"
+
 CHANNEL_ID = int(os.getenv("CHANNEL_ID", "0"))
 ADMIN_ID = int(os.getenv("ADMIN_ID", "0"))
 SUPPORT_CHAT_ID = int(os.getenv("SUPPORT_CHAT_ID", "0"))
@@ -40,41 +96,332 @@ BOT_USERNAME = os.getenv("BOT_USERNAME")
 # Optional (не обов'язково; в цьому коді не потрібен)
 SUPPORT_USERNAME = os.getenv("SUPPORT_USERNAME", "").strip()
 
+# Скільки користувачів /grant_bulk і /gift_bulk обробляють паралельно
+# (ліміт Telegram — ~30 повідомлень/сек на бота)
+BULK_CONCURRENCY = max(1, int(os.getenv("BULK_CONCURRENCY", "8")))
+
+# Захист від флуду (/access, «Загубив посилання», «Не прийшло посилання»):
+# token bucket на користувача — RATE_LIMIT_CAPACITY запитів підряд,
+# далі один запит на RATE_LIMIT_REFILL_SECONDS секунд.
+RATE_LIMIT_CAPACITY = float(os.getenv("RATE_LIMIT_CAPACITY", "3"))
+RATE_LIMIT_REFILL_SECONDS = float(os.getenv("RATE_LIMIT_REFILL_SECONDS", "20"))
+RATE_LIMIT_MAX_USERS = int(os.getenv("RATE_LIMIT_MAX_USERS", "10000"))
+# вартість команди в токенах, напр. "access=1,support_lost=1,support_nolink=2"
+RATE_LIMIT_COSTS = {
+    name.strip(): float(cost)
+    for name, cost in (
+        item.split("=", 1)
+        for item in os.getenv("RATE_LIMIT_COSTS", "access=1,support_lost=1,support_nolink=1").split(",")
+        if "=" in item
+    )
+}
+
+# Загальний ліміт фонових розсилок (нагадування тощо), повідомлень/сек
+SEND_RATE_LIMIT = float(os.getenv("SEND_RATE_LIMIT", "20"))
+
+# Нагадування тим, хто почав оплату і не завершив (awaiting_payment = 1).
+# REMINDER_DELAYS — затримки від last_activity у секундах, по одному
+# нагадуванню на кожну; порожнє значення вимикає нагадування.
+REMINDER_DELAYS = [int(x) for x in os.getenv("REMINDER_DELAYS", "3600,86400").split(",") if x.strip()]
+REMINDER_INTERVAL = float(os.getenv("REMINDER_INTERVAL", "60"))
+REMINDER_BATCH = int(os.getenv("REMINDER_BATCH", "200"))
+# при першому запуску не нагадуємо тим, хто «застряг» давніше за це
+REMINDER_CATCHUP_SECONDS = int(os.getenv("REMINDER_CATCHUP_SECONDS", "86400"))
+
+# Уроки-нагадування після видачі доступу: затримки (сек) від оплати /
+# активації подарунка, по листу на кожну; порожнє значення вимикає розсилку.
+DRIP_DELAYS = [int(x) for x in os.getenv("DRIP_DELAYS", "86400,259200,604800").split(",") if x.strip()]
+# у пам'яті тримаємо лише найближчі задачі: не далі DRIP_WINDOW секунд
+# і не більше DRIP_HEAP_MAX штук
+DRIP_WINDOW = int(os.getenv("DRIP_WINDOW", "3600"))
+DRIP_HEAP_MAX = int(os.getenv("DRIP_HEAP_MAX", "10000"))
+DRIP_BATCH = int(os.getenv("DRIP_BATCH", "200"))
+
+# Журнал подій воронки: буфер у пам'яті скидається в БД одним
+# multi-row INSERT раз на EVENTS_FLUSH_INTERVAL секунд або по EVENTS_BATCH подій
+EVENTS_FLUSH_INTERVAL = float(os.getenv("EVENTS_FLUSH_INTERVAL", "5"))
+EVENTS_BATCH = int(os.getenv("EVENTS_BATCH", "500"))
+EVENTS_MAX_BUFFER = int(os.getenv("EVENTS_MAX_BUFFER", "20000"))
+
+# Outbox: повідомлення користувачам і в підтримку пишуться в БД разом зі
+# зміною стану, а фоновий диспетчер надсилає їх пачками з повторами.
+# Тимчасові помилки повторюються з експоненційним backoff до OUTBOX_MAX_ATTEMPTS.
+OUTBOX_BATCH = int(os.getenv("OUTBOX_BATCH", "50"))
+OUTBOX_POLL_INTERVAL = float(os.getenv("OUTBOX_POLL_INTERVAL", "30"))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "8"))
+OUTBOX_BACKOFF_BASE = float(os.getenv("OUTBOX_BACKOFF_BASE", "5"))
+OUTBOX_BACKOFF_MAX = float(os.getenv("OUTBOX_BACKOFF_MAX", "3600"))
+OUTBOX_KEEP_DAYS = float(os.getenv("OUTBOX_KEEP_DAYS", "7"))
+
+# Запис вхідних апдейтів webhook для відтворення інцидентів і бенчмарків
+# (див. app/replay.py). Порожній RECORD_DIR — запис вимкнено.
+RECORD_DIR = os.getenv("RECORD_DIR", "").strip()
+RECORD_ROTATE_MB = float(os.getenv("RECORD_ROTATE_MB", "64"))
+RECORD_KEEP = int(os.getenv("RECORD_KEEP", "48"))
+RECORD_FLUSH_INTERVAL = float(os.getenv("RECORD_FLUSH_INTERVAL", "2"))
+RECORD_MAX_BUFFER = int(os.getenv("RECORD_MAX_BUFFER", "10000"))
+
+# Дайджест підтримки: звернення збираються у вікна по SUPPORT_DIGEST_WINDOW
+# секунд і йдуть у SUPPORT_CHAT_ID одним повідомленням (медіа — альбомами).
+# 0 — кожне звернення окремо, як раніше.
+SUPPORT_DIGEST_WINDOW = int(os.getenv("SUPPORT_DIGEST_WINDOW", "0"))
+SUPPORT_DIGEST_MAX_TICKETS = int(os.getenv("SUPPORT_DIGEST_MAX_TICKETS", "10"))
+
+DB_PATH = os.getenv("DB_PATH", "database.db")
+
+# Онлайн-бекапи SQLite (VACUUM INTO у WAL-режимі, gzip, ротація).
+# BACKUP_INTERVAL_HOURS=0 вимикає розклад; /backup працює завжди.
+BACKUP_DIR = os.getenv("BACKUP_DIR", "backups")
+BACKUP_INTERVAL_HOURS = float(os.getenv("BACKUP_INTERVAL_HOURS", "24"))
+BACKUP_KEEP = int(os.getenv("BACKUP_KEEP", "7"))
+BACKUP_MAX_AGE_DAYS = float(os.getenv("BACKUP_MAX_AGE_DAYS", "30"))
+
+# Логи та трасування апдейтів: один JSON-рядок на апдейт.
+# TRACE_SAMPLE_RATE — частка звичайних апдейтів, що логуються (0..1);
+# повільні (>= TRACE_SLOW_MS) та з помилкою логуються завжди і повністю.
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "0.1"))
+TRACE_SLOW_MS = float(os.getenv("TRACE_SLOW_MS", "1000"))
+
+# Моніторинг event loop: як часто міряти затримку планування і з якої
+# затримки (мс) писати попередження зі стеком заблокованого коду.
+LOOP_LAG_INTERVAL = float(os.getenv("LOOP_LAG_INTERVAL", "0.5"))
+LOOP_LAG_WARN_MS = float(os.getenv("LOOP_LAG_WARN_MS", "200"))
+
 missing = []
 if not BOT_TOKEN: missing.append("BOT_TOKEN")
-if not WEBHOOK_TOKEN: missing.append("WEBHOOK_TOKEN")
+if INGESTION_MODE not in ("webhook", "polling"): missing.append("INGESTION_MODE (webhook|polling)")
+if INGESTION_MODE == "webhook" and not WEBHOOK_TOKEN: missing.append("WEBHOOK_TOKEN")
 if not CHANNEL_ID: missing.append("CHANNEL_ID")
 if not ADMIN_ID: missing.append("ADMIN_ID")
 if not SUPPORT_CHAT_ID: missing.append("SUPPORT_CHAT_ID")
 if not PAYMENT_BUTTON_URL: missing.append("PAYMENT_BUTTON_URL")
 if not KEEP_ALIVE_URL: missing.append("KEEP_ALIVE_URL")
 if not BOT_USERNAME: missing.append("BOT_USERNAME")
+if not 1 <= WEBHOOK_MAX_CONNECTIONS <= 100: missing.append("WEBHOOK_MAX_CONNECTIONS (1..100)")
 
 if missing:
     raise RuntimeError("Missing ENV variables: " + ", ".join(missing))
 
+# ===================== LOGGING / TRACING =====================
+
+logging.basicConfig(
+    level=LOG_LEVEL,
+    format="%(asctime)s %(levelname)s %(name)s: %(message)s"
+)
+log = logging.getLogger("bot")
+# httpx логує кожен запит до Bot API на INFO — це вже є у трейсах
+logging.getLogger("httpx").setLevel(logging.WARNING)
+
+# трейси — чистий JSON, без префіксів
+trace_log = logging.getLogger("bot.trace")
+trace_log.propagate = False
+_trace_handler = logging.StreamHandler()
+_trace_handler.setFormatter(logging.Formatter("%(message)s"))
+trace_log.addHandler(_trace_handler)
+
+TRACE_MAX_CALLS = 200
+
+
+class Trace:
+    __slots__ = ("started", "update_id", "user_id", "handler", "outcome", "error", "spans", "counts", "calls")
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.update_id: int | None = None
+        self.user_id: int | None = None
+        self.handler: str | None = None
+        self.outcome: str | None = None
+        self.error: str | None = None
+        self.spans = {"parse": 0.0, "dispatch": 0.0, "db": 0.0, "net": 0.0}
+        self.counts = {"db": 0, "net": 0}
+        # окремі виклики — потрібні лише для повного логу повільних апдейтів
+        self.calls: list[tuple[str, str, float, float]] = []
+
+    def record(self, kind: str, name: str, t0: float):
+        now = time.perf_counter()
+        ms = (now - t0) * 1000
+        self.spans[kind] += ms
+        if kind in self.counts:
+            self.counts[kind] += 1
+        if len(self.calls) < TRACE_MAX_CALLS:
+            self.calls.append((kind, name, (t0 - self.started) * 1000, ms))
+
+
+current_trace: contextvars.ContextVar[Trace | None] = contextvars.ContextVar("current_trace", default=None)
+
+
+def trace_record(kind: str, name: str, t0: float):
+    trace = current_trace.get()
+    if trace is not None:
+        trace.record(kind, name, t0)
+
+
+def finish_trace(trace: Trace):
+    total_ms = (time.perf_counter() - trace.started) * 1000
+    slow = total_ms >= TRACE_SLOW_MS
+    full = slow or trace.outcome == "error"
+
+    if not full and random.random() >= TRACE_SAMPLE_RATE:
+        return
+
+    record = {
+        "ts": round(time.time(), 3),
+        "update_id": trace.update_id,
+        "user_id": trace.user_id,
+        "handler": trace.handler,
+        "outcome": trace.outcome or ("ok" if trace.handler else "unhandled"),
+        "total_ms": round(total_ms, 2),
+        "spans": {k: round(v, 2) for k, v in trace.spans.items()},
+        "db_calls": trace.counts["db"],
+        "net_calls": trace.counts["net"],
+        "slow": slow,
+    }
+    if trace.error:
+        record["error"] = trace.error
+    if full:
+        record["calls"] = [
+            {"kind": kind, "name": name, "at_ms": round(at, 2), "ms": round(ms, 2)}
+            for kind, name, at, ms in trace.calls
+        ]
+
+    trace_log.info(json.dumps(record, ensure_ascii=False))
+
+
+class TracedRequest(HTTPXRequest):
+    # кожен виклик Bot API потрапляє у span "net" поточного апдейту
+
+    async def do_request(self, url: str, *args, **kwargs):
+        t0 = time.perf_counter()
+        try:
+            return await super().do_request(url, *args, **kwargs)
+        finally:
+            trace_record("net", url.rsplit("/", 1)[-1], t0)
+
+
+class TracedConnection:
+    # обгортка над aiosqlite.Connection: кожен запит потрапляє у span "db"
+
+    def __init__(self, conn: aiosqlite.Connection):
+        self._conn = conn
+        self._write_lock = asyncio.Lock()
+        self._writer: asyncio.Task | None = None
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+    @staticmethod
+    def _name(sql: str) -> str:
+        return " ".join(sql.split())[:80]
+
+    async def execute(self, sql: str, parameters=None):
+        t0 = time.perf_counter()
+        try:
+            return await self._conn.execute(sql, parameters)
+        finally:
+            trace_record("db", self._name(sql), t0)
+
+    async def executemany(self, sql: str, parameters):
+        t0 = time.perf_counter()
+        try:
+            return await self._conn.executemany(sql, parameters)
+        finally:
+            trace_record("db", self._name(sql), t0)
+
+    async def commit(self):
+        t0 = time.perf_counter()
+        try:
+            return await self._conn.commit()
+        finally:
+            trace_record("db", "COMMIT", t0)
+
+    @contextlib.asynccontextmanager
+    async def transaction(self):
+        # З'єднання одне на всіх, і кожен await віддає керування: без локу чужий
+        # commit міг би зафіксувати половину нашої транзакції (доступ без
+        # outbox-рядка). Тому всі записи — лише всередині transaction(): один
+        # writer за раз, commit наприкінці, rollback при помилці. Вкладений
+        # блок у тій самій задачі — частина зовнішньої транзакції.
+        # Мережевих викликів усередині блоку не робимо — лок тримають недовго.
+        task = asyncio.current_task()
+        if self._writer is task:
+            yield self
+            return
+        async with self._write_lock:
+            self._writer = task
+            try:
+                yield self
+                await self.commit()
+            except BaseException:
+                await self._conn.rollback()
+                raise
+            finally:
+                self._writer = None
+
+
+def traced_handler(callback):
+    @functools.wraps(callback)
+    async def wrapper(update, context):
+        trace = current_trace.get()
+        if trace is not None:
+            trace.handler = callback.__name__
+        try:
+            return await callback(update, context)
+        except Exception as e:
+            if trace is not None:
+                trace.outcome = "error"
+                trace.error = repr(e)
+            raise
+
+    return wrapper
+
+
+def instrument_handlers():
+    for handlers in telegram_app.handlers.values():
+        for handler in handlers:
+            handler.callback = traced_handler(handler.callback)
+
+
+async def on_error(update: object, context: ContextTypes.DEFAULT_TYPE):
+    log.error("Handler error", exc_info=context.error)
+
+
 # ===================== APP =====================
 
 app = FastAPI()
-telegram_app = Application.builder().token(BOT_TOKEN).build()
 
-DB_PATH = "database.db"
-db: aiosqlite.Connection | None = None
+_builder = (
+    Application.builder()
+    .token(BOT_TOKEN)
+    .request(TracedRequest(connection_pool_size=256))
+)
+if TELEGRAM_API_URL:
+    _builder = _builder.base_url(TELEGRAM_API_URL).base_file_url(
+        TELEGRAM_API_URL.rsplit("/bot", 1)[0] + "/file/bot"
+    )
+telegram_app = _builder.build()
+telegram_app.add_error_handler(on_error)
 
+db: TracedConnection | None = None
+# знято, поки /restore підміняє файл БД: get_db() не відкриває його наново
+db_ready = asyncio.Event()
+db_ready.set()
 
-# ===================== DB =====================
 
-async def get_db() -> aiosqlite.Connection:
-    global db
-    if db is None:
-        db = await aiosqlite.connect(DB_PATH)
-        db.row_factory = aiosqlite.Row
-    return db
+# ===================== MIGRATIONS =====================
+# Схема версіонується через PRAGMA user_version. Міграція — async-функція
+# (conn) без commit; раннер виконує її в одній транзакції разом із записом
+# нового user_version. Зміни схеми — лише новою міграцією в кінці MIGRATIONS,
+# старі не редагуємо.
 
+async def add_column(conn, table: str, column: str, decl: str):
+    cur = await conn.execute(f"PRAGMA table_info({table})")
+    if column not in {r["name"] for r in await cur.fetchall()}:
+        await conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {decl}")
 
-async def init_db():
-    conn = await get_db()
 
+async def migration_001_baseline(conn):
+    # схема, яку раніше створював init_db() — для старих БД з user_version = 0
     await conn.execute("""
         CREATE TABLE IF NOT EXISTS users (
             telegram_id INTEGER PRIMARY KEY,
@@ -90,16 +437,10 @@ async def init_db():
     """)
 
     # На випадок якщо таблиця існувала без колонок:
-    for stmt in [
-        "ALTER TABLE users ADD COLUMN has_access INTEGER DEFAULT 0",
-        "ALTER TABLE users ADD COLUMN awaiting_payment INTEGER DEFAULT 0",
-        "ALTER TABLE users ADD COLUMN awaiting_payment_type TEXT DEFAULT NULL",
-        "ALTER TABLE users ADD COLUMN support_mode INTEGER DEFAULT 0",
-    ]:
-        try:
-            await conn.execute(stmt)
-        except Exception:
-            pass
+    await add_column(conn, "users", "has_access", "INTEGER DEFAULT 0")
+    await add_column(conn, "users", "awaiting_payment", "INTEGER DEFAULT 0")
+    await add_column(conn, "users", "awaiting_payment_type", "TEXT DEFAULT NULL")
+    await add_column(conn, "users", "support_mode", "INTEGER DEFAULT 0")
 
     await conn.execute("""
         CREATE TABLE IF NOT EXISTS purchases (
@@ -135,32 +476,236 @@ async def init_db():
         )
     """)
 
-    await conn.commit()
+    # службовий key-value стан (водяні знаки фонових задач тощо)
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS bot_state (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        )
+    """)
 
+    # які нагадування про оплату вже надіслано (кожне — не більше одного разу)
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS payment_reminders (
+            telegram_id INTEGER,
+            stage INTEGER,
+            sent_at INTEGER,
+            status TEXT,
+            PRIMARY KEY (telegram_id, stage)
+        )
+    """)
 
-async def upsert_user(user):
-    conn = await get_db()
-    now = int(time.time())
+    # журнал подій воронки (лише INSERT)
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS events (
+            id INTEGER PRIMARY KEY,
+            ts INTEGER NOT NULL,
+            telegram_id INTEGER,
+            event TEXT NOT NULL,
+            source TEXT
+        )
+    """)
+
+    # покриваючий індекс для /funnel: діапазон по часу в межах однієї події
+    await conn.execute("""
+        CREATE INDEX IF NOT EXISTS idx_events_event_ts
+        ON events (event, ts, telegram_id, source)
+    """)
+
+    # частковий індекс: лише ті, хто зараз очікує оплату
+    await conn.execute("""
+        CREATE INDEX IF NOT EXISTS idx_users_awaiting_payment
+        ON users (awaiting_payment, last_activity)
+        WHERE awaiting_payment = 1
+    """)
+
+    # каталог продуктів (курсів); хендлери читають його зі снапшоту в пам'яті
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS products (
+            id INTEGER PRIMARY KEY,
+            name TEXT NOT NULL,
+            amount REAL NOT NULL,
+            currency TEXT NOT NULL,
+            payment_url TEXT NOT NULL,
+            channel_id INTEGER NOT NULL,
+            start_text TEXT DEFAULT NULL,
+            gift_text TEXT DEFAULT NULL,
+            is_active INTEGER DEFAULT 1,
+            created_at INTEGER
+        )
+    """)
+
+    # доступи по продуктах (users.has_access = «є хоч один доступ»)
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS access_grants (
+            telegram_id INTEGER,
+            product_id INTEGER,
+            granted_at INTEGER,
+            PRIMARY KEY (telegram_id, product_id)
+        )
+    """)
+
+    # outbox: намір надіслати повідомлення, записаний разом зі зміною стану
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS outbox (
+            id INTEGER PRIMARY KEY,
+            kind TEXT NOT NULL,
+            chat_id INTEGER NOT NULL,
+            payload TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER DEFAULT 0,
+            next_attempt_at INTEGER NOT NULL,
+            created_at INTEGER,
+            sent_at INTEGER,
+            last_error TEXT
+        )
+    """)
 
+    # диспетчер вибирає тільки pending-рядки, яким настав час
     await conn.execute("""
-        INSERT OR IGNORE INTO users
-        (telegram_id, username, first_name, joined_at, last_activity, has_access, awaiting_payment, awaiting_payment_type, support_mode)
-        VALUES (?, ?, ?, ?, ?, 0, 0, NULL, 0)
-    """, (user.id, user.username, user.first_name, now, now))
+        CREATE INDEX IF NOT EXISTS idx_outbox_due
+        ON outbox (next_attempt_at, id)
+        WHERE status = 'pending'
+    """)
+
+    await add_column(conn, "users", "awaiting_product_id", "INTEGER DEFAULT NULL")
+    await add_column(conn, "gifts", "product_id", "INTEGER DEFAULT NULL")
+    await add_column(conn, "access_links", "product_id", "INTEGER DEFAULT NULL")
 
+    # одноразово: старі доступи — це доступи до продукту за замовчуванням
+    cur = await conn.execute("SELECT 1 FROM bot_state WHERE key = 'backfill:access_grants'")
+    if await cur.fetchone() is None:
+        await conn.execute("""
+            INSERT OR IGNORE INTO access_grants (telegram_id, product_id, granted_at)
+            SELECT telegram_id, ?, COALESCE(last_activity, joined_at)
+            FROM users WHERE has_access = 1
+        """, (PRODUCT_ID,))
+        await put_state(conn, "backfill:access_grants", "1")
+
+
+async def migration_002_indexes(conn):
+    # /stats: approved за період; покриваючий — суми рахуються без читання таблиці
     await conn.execute("""
-        UPDATE users
-        SET username = ?, first_name = ?, last_activity = ?
-        WHERE telegram_id = ?
-    """, (user.username, user.first_name, now, user.id))
+        CREATE INDEX IF NOT EXISTS idx_purchases_status_paid
+        ON purchases (status, paid_at, product_id, currency, amount)
+    """)
 
-    await conn.commit()
+    await conn.execute("""
+        CREATE INDEX IF NOT EXISTS idx_access_links_telegram
+        ON access_links (telegram_id)
+    """)
+
+    await conn.execute("""
+        CREATE INDEX IF NOT EXISTS idx_gifts_buyer
+        ON gifts (buyer_telegram_id)
+    """)
+
+
+async def migration_003_scheduled_jobs(conn):
+    # відкладені задачі (уроки після оплати); UNIQUE — серію не заплануємо двічі
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS scheduled_jobs (
+            id INTEGER PRIMARY KEY,
+            kind TEXT NOT NULL,
+            telegram_id INTEGER NOT NULL,
+            product_id INTEGER,
+            stage INTEGER NOT NULL,
+            due_at INTEGER NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            created_at INTEGER,
+            done_at INTEGER,
+            UNIQUE (kind, telegram_id, product_id, stage)
+        )
+    """)
+
+    await conn.execute("""
+        CREATE INDEX IF NOT EXISTS idx_scheduled_jobs_due
+        ON scheduled_jobs (due_at, id)
+        WHERE status = 'pending'
+    """)
+
+
+MIGRATIONS = [
+    (1, "baseline schema", migration_001_baseline),
+    (2, "indexes: purchases, access_links, gifts", migration_002_indexes),
+    (3, "scheduled_jobs", migration_003_scheduled_jobs),
+]
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+
+async def schema_version(conn) -> int:
+    cur = await conn.execute("PRAGMA user_version")
+    return (await cur.fetchone())[0]
+
+
+async def migrate(conn) -> list[tuple[int, str, float]]:
+    # → [(версія, назва, секунди)] застосованих міграцій; актуальна БД — один PRAGMA
+    current = await schema_version(conn)
+    if current >= SCHEMA_VERSION:
+        if current > SCHEMA_VERSION:
+            log.warning("DB schema version %d is newer than this code (%d)", current, SCHEMA_VERSION)
+        return []
+
+    applied = []
+    for version, name, migration in MIGRATIONS:
+        if version <= current:
+            continue
+        t0 = time.perf_counter()
+        await conn.execute("BEGIN IMMEDIATE")
+        try:
+            await migration(conn)
+            await conn.execute(f"PRAGMA user_version = {version}")
+            await conn.commit()
+        except Exception:
+            await conn.rollback()
+            log.exception("Migration %d (%s) failed, rolled back", version, name)
+            raise
+        applied.append((version, name, time.perf_counter() - t0))
+    return applied
+
+
+# ===================== DB =====================
+
+async def get_db() -> TracedConnection:
+    global db
+    if db is None:
+        await db_ready.wait()
+        conn = await aiosqlite.connect(DB_PATH)
+        conn.row_factory = aiosqlite.Row
+        # WAL: читачі (бекап, migrate.py) не блокують записи бота
+        await conn.execute("PRAGMA journal_mode=WAL")
+        db = TracedConnection(conn)
+    return db
+
+
+async def init_db():
+    conn = await get_db()
+    for version, name, seconds in await migrate(conn):
+        log.info("Migration %d (%s) applied in %.2fs", version, name, seconds)
+
+
+async def upsert_user(user):
+    conn = await get_db()
+    now = int(time.time())
+
+    async with conn.transaction():
+        await conn.execute("""
+            INSERT OR IGNORE INTO users
+            (telegram_id, username, first_name, joined_at, last_activity, has_access, awaiting_payment, awaiting_payment_type, support_mode)
+            VALUES (?, ?, ?, ?, ?, 0, 0, NULL, 0)
+        """, (user.id, user.username, user.first_name, now, now))
+
+        await conn.execute("""
+            UPDATE users
+            SET username = ?, first_name = ?, last_activity = ?
+            WHERE telegram_id = ?
+        """, (user.username, user.first_name, now, user.id))
 
 
 async def set_support_mode(user_id: int, mode: int):
     conn = await get_db()
-    await conn.execute("UPDATE users SET support_mode = ? WHERE telegram_id = ?", (mode, user_id))
-    await conn.commit()
+    async with conn.transaction():
+        await conn.execute("UPDATE users SET support_mode = ? WHERE telegram_id = ?", (mode, user_id))
 
 
 async def get_user_row(user_id: int):
@@ -169,40 +714,496 @@ async def get_user_row(user_id: int):
     return await cur.fetchone()
 
 
-async def create_invite_link(user_id: int) -> str:
+async def request_invite_link(product: "Product") -> str:
     invite = await telegram_app.bot.create_chat_invite_link(
-        chat_id=CHANNEL_ID,
+        chat_id=product.channel_id,
         member_limit=1
     )
-
-    conn = await get_db()
-    await conn.execute("""
-        INSERT INTO access_links (telegram_id, invite_link, created_at, used)
-        VALUES (?, ?, ?, 0)
-    """, (user_id, invite.invite_link, int(time.time())))
-
-    await conn.commit()
     return invite.invite_link
 
 
-async def create_gift(buyer_id: int) -> str:
+async def create_invite_link(user_id: int, product: "Product") -> str:
+    link = await request_invite_link(product)
+
     conn = await get_db()
+    async with conn.transaction():
+        await conn.execute("""
+            INSERT INTO access_links (telegram_id, invite_link, created_at, used, product_id)
+            VALUES (?, ?, ?, 0, ?)
+        """, (user_id, link, int(time.time()), product.id))
+    return link
+
+
+async def insert_gift(conn, buyer_id: int, product: "Product") -> str:
+    # без commit — у transaction() того, хто викликає
     code = secrets.token_urlsafe(16)
     now = int(time.time())
 
     await conn.execute("""
-        INSERT INTO gifts (buyer_telegram_id, gift_code, created_at)
-        VALUES (?, ?, ?)
-    """, (buyer_id, code, now))
+        INSERT INTO gifts (buyer_telegram_id, gift_code, created_at, product_id)
+        VALUES (?, ?, ?, ?)
+    """, (buyer_id, code, now, product.id))
 
-    await conn.commit()
     return code
 
 
+async def create_gift(buyer_id: int, product: "Product") -> str:
+    conn = await get_db()
+    async with conn.transaction():
+        code = await insert_gift(conn, buyer_id, product)
+    return code
+
+
+async def grant_access(conn, user_id: int, product: "Product", now: int):
+    # без commit — у transaction() того, хто викликає
+    await conn.execute(
+        "UPDATE users SET has_access = 1 WHERE telegram_id = ?",
+        (user_id,)
+    )
+    await conn.execute(
+        "INSERT OR IGNORE INTO access_grants (telegram_id, product_id, granted_at) VALUES (?, ?, ?)",
+        (user_id, product.id, now)
+    )
+    await schedule_drip(conn, [user_id], product, now)
+
+
+async def granted_products(user_id: int) -> list["Product"]:
+    conn = await get_db()
+    cur = await conn.execute(
+        "SELECT product_id FROM access_grants WHERE telegram_id = ? ORDER BY product_id",
+        (user_id,)
+    )
+    return [p for p in (get_product(r["product_id"]) for r in await cur.fetchall()) if p]
+
+
+async def issue_access_links(user_id: int) -> str:
+    # нові посилання на всі продукти користувача; текст кешуємо для flood control
+    # has_access без записів у access_grants — доступ до продукту за замовчуванням
+    products = await granted_products(user_id) or [default_product()]
+    links = [await create_invite_link(user_id, p) for p in products]
+
+    if len(products) == 1:
+        text = links[0]
+    else:
+        text = "\n\n".join(f"<b>{p.name}</b>:\n{link}" for p, link in zip(products, links))
+
+    flood_limiter.remember_link(user_id, text)
+    return text
+
+
+async def get_state(key: str) -> str | None:
+    conn = await get_db()
+    cur = await conn.execute("SELECT value FROM bot_state WHERE key = ?", (key,))
+    row = await cur.fetchone()
+    return row["value"] if row else None
+
+
+async def put_state(conn, key: str, value: str):
+    # без commit — пишеться в transaction() того, хто викликає
+    await conn.execute(
+        "INSERT INTO bot_state (key, value) VALUES (?, ?) "
+        "ON CONFLICT(key) DO UPDATE SET value = excluded.value",
+        (key, value)
+    )
+
+
 def is_admin(update: Update) -> bool:
     return update.effective_user and update.effective_user.id == ADMIN_ID
 
 
+# Текст подарунка (для пересилання / автоматичного надсилання отримувачу)
+GIFT_MESSAGE_TEXT = (
+    "🎁 <b>Вам зробили подарунок!</b>\n\n"
+    "Для вас придбали курс\n"
+    "«Сам Собі Масажист» 💆‍♀️\n\n"
+    "Це курс, який допоможе:\n"
+    "• зняти напругу\n"
+    "• краще відчувати своє тіло\n"
+    "• піклуватися про себе щодня\n\n"
+    "Натисніть кнопку нижче,\n"
+    "щоб отримати доступ до курсу 👇"
+)
+
+
+def gift_keyboard(gift_code: str) -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton(
+            "🔓 Отримати доступ",
+            url=f"https://t.me/{BOT_USERNAME}?start=gift_{gift_code}"
+        )]
+    ])
+
+
+# ===================== CATALOG =====================
+
+class Product(NamedTuple):
+    id: int
+    name: str
+    amount: float
+    currency: str
+    payment_url: str
+    channel_id: int
+    start_text: str | None
+    gift_text: str | None
+    is_active: bool
+
+
+class Catalog(NamedTuple):
+    products: MappingProxyType
+    default_id: int
+
+
+# Незмінний снапшот: /reload_catalog збирає новий і підміняє посилання
+# одним присвоєнням, тож хендлери ніколи не бачать половину оновлення
+# і не ходять у SQLite за цінами чи каналами.
+catalog = Catalog(
+    MappingProxyType({
+        PRODUCT_ID: Product(
+            PRODUCT_ID, PRODUCT_NAME, AMOUNT, CURRENCY, PAYMENT_BUTTON_URL, CHANNEL_ID, None, None, True
+        )
+    }),
+    PRODUCT_ID
+)
+
+
+async def load_catalog() -> Catalog:
+    global catalog
+    conn = await get_db()
+    cur = await conn.execute("""
+        SELECT id, name, amount, currency, payment_url, channel_id, start_text, gift_text, is_active
+        FROM products
+        ORDER BY id
+    """)
+    products = {
+        r["id"]: Product(
+            r["id"], r["name"], r["amount"], r["currency"], r["payment_url"],
+            r["channel_id"], r["start_text"], r["gift_text"], bool(r["is_active"])
+        )
+        for r in await cur.fetchall()
+    }
+
+    # продукт з ENV — продукт за замовчуванням; додаємо, якщо його ще немає
+    if PRODUCT_ID not in products:
+        async with conn.transaction():
+            await conn.execute("""
+                INSERT OR IGNORE INTO products (id, name, amount, currency, payment_url, channel_id, is_active, created_at)
+                VALUES (?, ?, ?, ?, ?, ?, 1, ?)
+            """, (PRODUCT_ID, PRODUCT_NAME, AMOUNT, CURRENCY, PAYMENT_BUTTON_URL, CHANNEL_ID, int(time.time())))
+        products[PRODUCT_ID] = Product(
+            PRODUCT_ID, PRODUCT_NAME, AMOUNT, CURRENCY, PAYMENT_BUTTON_URL,
+            CHANNEL_ID, None, None, True
+        )
+
+    catalog = Catalog(MappingProxyType(products), PRODUCT_ID)
+    return catalog
+
+
+def default_product() -> Product:
+    snap = catalog
+    return snap.products[snap.default_id]
+
+
+def get_product(product_id: int | None) -> Product | None:
+    if product_id is None:
+        return default_product()
+    return catalog.products.get(product_id)
+
+
+def parse_product_arg(value: str) -> Product | None:
+    # "5" → продукт 5, якщо він є і активний
+    if not value.isdigit():
+        return None
+    product = get_product(int(value))
+    return product if product and product.is_active else None
+
+
+def gift_text(product: Product) -> str:
+    if product.gift_text:
+        return product.gift_text
+    if product.id == PRODUCT_ID:
+        return GIFT_MESSAGE_TEXT
+    return (
+        "🎁 <b>Вам зробили подарунок!</b>\n\n"
+        "Для вас придбали курс\n"
+        f"«{product.name}»\n\n"
+        "Натисніть кнопку нижче,\n"
+        "щоб отримати доступ до курсу 👇"
+    )
+
+
+def course_title(product: Product) -> str:
+    # у текстах продукту за замовчуванням — назва бренду курсу
+    return "Сам Собі Масажист" if product.id == PRODUCT_ID else product.name
+
+
+# ===================== FLOOD CONTROL =====================
+
+class TokenBucket:
+    __slots__ = ("tokens", "updated_at", "warned", "last_link")
+
+    def __init__(self, tokens: float, now: float):
+        self.tokens = tokens
+        self.updated_at = now
+        self.warned = False
+        self.last_link: str | None = None
+
+
+class FloodLimiter:
+    # Стан лише в пам'яті: OrderedDict як LRU, найстаріші записи — на початку.
+    # Запис, що не оновлювався довше за ttl, вже має повний bucket, тож його
+    # можна викинути без зміни поведінки.
+
+    def __init__(self, capacity: float, refill_seconds: float, max_users: int):
+        self.capacity = capacity
+        self.rate = 1.0 / refill_seconds if refill_seconds > 0 else float("inf")
+        self.max_users = max_users
+        self.ttl = capacity * refill_seconds
+        self.buckets: OrderedDict[int, TokenBucket] = OrderedDict()
+
+    def _evict(self, now: float):
+        while self.buckets:
+            bucket = next(iter(self.buckets.values()))
+            if len(self.buckets) <= self.max_users and now - bucket.updated_at <= self.ttl:
+                break
+            self.buckets.popitem(last=False)
+
+    def take(self, user_id: int, cost: float) -> bool:
+        now = time.monotonic()
+        bucket = self.buckets.get(user_id)
+
+        if bucket is None:
+            bucket = TokenBucket(self.capacity, now)
+            self.buckets[user_id] = bucket
+        else:
+            bucket.tokens = min(self.capacity, bucket.tokens + (now - bucket.updated_at) * self.rate)
+            bucket.updated_at = now
+            self.buckets.move_to_end(user_id)
+
+        self._evict(now)
+
+        if bucket.tokens >= cost:
+            bucket.tokens -= cost
+            bucket.warned = False
+            return True
+        return False
+
+    def get(self, user_id: int) -> TokenBucket | None:
+        return self.buckets.get(user_id)
+
+    def remember_link(self, user_id: int, link: str):
+        bucket = self.buckets.get(user_id)
+        if bucket is not None:
+            bucket.last_link = link
+
+
+flood_limiter = FloodLimiter(RATE_LIMIT_CAPACITY, RATE_LIMIT_REFILL_SECONDS, RATE_LIMIT_MAX_USERS)
+
+FLOOD_WAIT_TEXT = "⏳ Забагато запитів. Спробуйте, будь ласка, трохи пізніше 🙏"
+
+
+async def throttled(update: Update, command: str) -> bool:
+    # True — запит відхилено; відповідаємо без нових викликів API і записів у БД
+    user = update.effective_user
+    if not user or user.id == ADMIN_ID:
+        return False
+
+    if flood_limiter.take(user.id, RATE_LIMIT_COSTS.get(command, 1.0)):
+        return False
+
+    bucket = flood_limiter.get(user.id)
+    q = update.callback_query
+    if q:
+        await q.answer(FLOOD_WAIT_TEXT)
+
+    # повідомлення в чат — лише один раз, поки користувач не дочекається
+    if bucket.warned:
+        return True
+    bucket.warned = True
+
+    if bucket.last_link:
+        text = "🔑 Ваше актуальне посилання:\n" + bucket.last_link
+    else:
+        text = FLOOD_WAIT_TEXT
+
+    message = q.message if q else update.message
+    if message:
+        await message.reply_text(text, parse_mode="HTML")
+    return True
+
+
+# ===================== FUNNEL EVENTS =====================
+
+class EventLog:
+    # Append-only журнал подій. Хендлер лише додає кортеж у список (без I/O),
+    # фонова задача скидає накопичене однією транзакцією.
+
+    CHUNK = 200  # рядків на один INSERT (4 параметри × 200 < ліміту SQLite)
+
+    def __init__(self, flush_interval: float, batch: int, max_buffer: int):
+        self.flush_interval = flush_interval
+        self.batch = batch
+        self.max_buffer = max_buffer
+        self.buffer: list[tuple] = []
+        self.dropped = 0
+        self._wakeup = asyncio.Event()
+
+    def add(self, user_id: int | None, event: str, source: str | None = None):
+        if len(self.buffer) >= self.max_buffer:
+            self.dropped += 1
+            return
+        self.buffer.append((int(time.time()), user_id, event, source))
+        if len(self.buffer) >= self.batch:
+            self._wakeup.set()
+
+    async def flush(self):
+        if not self.buffer:
+            return
+        rows, self.buffer = self.buffer, []
+
+        conn = await get_db()
+        async with conn.transaction():
+            for i in range(0, len(rows), self.CHUNK):
+                chunk = rows[i:i + self.CHUNK]
+                await conn.execute(
+                    "INSERT INTO events (ts, telegram_id, event, source) VALUES "
+                    + ",".join(["(?, ?, ?, ?)"] * len(chunk)),
+                    [v for row in chunk for v in row]
+                )
+
+        if self.dropped:
+            log.warning("Event log buffer overflow: dropped %d events", self.dropped)
+            self.dropped = 0
+
+    async def run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+
+
+event_log = EventLog(EVENTS_FLUSH_INTERVAL, EVENTS_BATCH, EVENTS_MAX_BUFFER)
+
+
+def track_event(context: ContextTypes.DEFAULT_TYPE, user_id: int, event: str, source: str | None = None):
+    # джерело (deep link з /start) пам'ятаємо в user_data, щоб позначати ним
+    # і подальші кроки воронки. user_data не переживає рестарт, тож /funnel
+    # бере джерело користувача з його першого start, а не з цих подій
+    event_log.add(user_id, event, source or context.user_data.get("source"))
+
+
+# ===================== TRAFFIC RECORDER =====================
+
+class TrafficRecorder:
+    # Webhook лише додає сирі байти апдейту в буфер (без I/O). Фонова задача
+    # пачками чистить PII, стискає і дописує у updates-<час>.jsonl.gz в окремому
+    # потоці. Кожен flush — окремий gzip-member, тож обірваний запис псує лише
+    # хвіст файлу. Telegram ID не чіпаємо: на них посилаються кнопки адміна.
+
+    PREFIX = "updates-"
+    SCRUB_KEYS = {
+        "first_name", "last_name", "username", "phone_number", "email",
+        "vcard", "bio", "latitude", "longitude", "address",
+    }
+    # код подарунка — це доступ до курсу: у /start gift_<код>, кнопках і
+    # callback data (admin:send_gift:<id>:<код>) лишаємо лише префікс
+    SECRET_RE = re.compile(r"(gift_|admin:send_gift:\d+:)([\w-]+)")
+
+    def __init__(self, directory: str, rotate_mb: float, keep: int, flush_interval: float, max_buffer: int):
+        self.directory = directory
+        self.rotate_bytes = int(rotate_mb * 1024 * 1024)
+        self.keep = keep
+        self.flush_interval = flush_interval
+        self.max_buffer = max_buffer
+        self.buffer: list[tuple[float, bytes]] = []
+        self.dropped = 0
+        self._path: str | None = None
+        self._lock = threading.Lock()
+
+    def add(self, body: bytes):
+        if len(self.buffer) >= self.max_buffer:
+            self.dropped += 1
+            return
+        self.buffer.append((time.time(), body))
+
+    @classmethod
+    def redact(cls, value: str) -> str:
+        return cls.SECRET_RE.sub(lambda m: m.group(1) + "x" * len(m.group(2)), value)
+
+    @classmethod
+    def scrub(cls, obj):
+        if isinstance(obj, dict):
+            for key, value in obj.items():
+                if key in cls.SCRUB_KEYS and isinstance(value, str):
+                    obj[key] = "x"
+                elif key in cls.SCRUB_KEYS and isinstance(value, (int, float)):
+                    obj[key] = 0
+                elif key in ("text", "caption") and isinstance(value, str):
+                    # команди (/start paid, /stats 2) лишаємо — від них залежить
+                    # маршрутизація; вільний текст замінюємо, зберігаючи довжину
+                    if not value.startswith("/"):
+                        obj[key] = "x" * len(value)
+                    else:
+                        obj[key] = cls.redact(value)
+                elif key in ("data", "callback_data", "url") and isinstance(value, str):
+                    obj[key] = cls.redact(value)
+                else:
+                    cls.scrub(value)
+        elif isinstance(obj, list):
+            for value in obj:
+                cls.scrub(value)
+        return obj
+
+    def _write(self, batch: list[tuple[float, bytes]]):
+        lines = []
+        for ts, body in batch:
+            try:
+                update = self.scrub(json.loads(body))
+            except ValueError:
+                continue
+            lines.append(json.dumps({"ts": round(ts, 4), "update": update}, ensure_ascii=False))
+        if not lines:
+            return
+
+        with self._lock:
+            os.makedirs(self.directory, exist_ok=True)
+            if self._path is None or os.path.getsize(self._path) >= self.rotate_bytes:
+                name = f"{self.PREFIX}{time.strftime('%Y%m%d-%H%M%S')}.jsonl.gz"
+                self._path = os.path.join(self.directory, name)
+                self._rotate()
+            with gzip.open(self._path, "ab") as f:
+                f.write(("\n".join(lines) + "\n").encode("utf-8"))
+
+    def _rotate(self):
+        names = sorted(
+            n for n in os.listdir(self.directory)
+            if n.startswith(self.PREFIX) and n.endswith(".jsonl.gz")
+        )
+        # новий файл ще не створений — лишаємо місце для нього
+        for name in names[:max(0, len(names) - self.keep + 1)]:
+            os.remove(os.path.join(self.directory, name))
+
+    async def flush(self):
+        if not self.buffer:
+            return
+        batch, self.buffer = self.buffer, []
+        await asyncio.to_thread(self._write, batch)
+
+        if self.dropped:
+            log.warning("Traffic recorder buffer overflow: dropped %d updates", self.dropped)
+            self.dropped = 0
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+
+recorder = TrafficRecorder(RECORD_DIR, RECORD_ROTATE_MB, RECORD_KEEP, RECORD_FLUSH_INTERVAL, RECORD_MAX_BUFFER)
+
+
 # ===================== KEEP ALIVE =====================
 
 async def keep_alive():
@@ -210,34 +1211,750 @@ async def keep_alive():
         try:
             async with aiohttp.ClientSession() as s:
                 await s.get(KEEP_ALIVE_URL)
-        except Exception:
-            pass
+        except Exception as e:
+            log.warning("keep_alive ping failed: %r", e)
         await asyncio.sleep(300)
 
 
+# ===================== BACKGROUND TASKS / LOOP MONITOR =====================
+
+class AsyncRateLimiter:
+    # Рівномірно розподіляє виклики: не частіше rate на секунду
+
+    def __init__(self, rate: float):
+        self.interval = 1.0 / rate if rate > 0 else 0.0
+        self._next = 0.0
+
+    async def acquire(self):
+        now = time.monotonic()
+        slot = max(now, self._next)
+        self._next = slot + self.interval
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+
+send_limiter = AsyncRateLimiter(SEND_RATE_LIMIT)
+
+
+class SupervisedTask:
+    __slots__ = ("name", "task", "state", "started_at", "restarts", "last_error")
+
+    def __init__(self, name: str):
+        self.name = name
+        self.task: asyncio.Task | None = None
+        self.state = "starting"
+        self.started_at: float | None = None
+        self.restarts = 0
+        self.last_error: str | None = None
+
+
+class TaskSupervisor:
+    # Фонові задачі з іменами: впала — логуємо і перезапускаємо з backoff
+
+    def __init__(self, min_backoff: float = 1.0, max_backoff: float = 300.0):
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self.tasks: dict[str, SupervisedTask] = {}
+
+    def start(self, name: str, factory):
+        st = SupervisedTask(name)
+        st.task = asyncio.create_task(self._run(st, factory), name=name)
+        self.tasks[name] = st
+
+    async def _run(self, st: SupervisedTask, factory):
+        backoff = self.min_backoff
+        while True:
+            st.state = "running"
+            st.started_at = time.time()
+            try:
+                await factory()
+                st.state = "finished"
+                return
+            except asyncio.CancelledError:
+                st.state = "cancelled"
+                raise
+            except Exception as e:
+                st.restarts += 1
+                st.last_error = repr(e)
+                st.state = "backoff"
+                log.exception("Background task %s crashed (restart #%d in %.0fs)", st.name, st.restarts, backoff)
+
+            # задача довго пропрацювала — починаємо backoff спочатку
+            if time.time() - st.started_at > self.max_backoff:
+                backoff = self.min_backoff
+            await asyncio.sleep(backoff)
+            backoff = min(backoff * 2, self.max_backoff)
+
+    def status(self) -> dict:
+        return {
+            name: {
+                "state": st.state,
+                "restarts": st.restarts,
+                "last_error": st.last_error,
+                "started_at": st.started_at,
+            }
+            for name, st in self.tasks.items()
+        }
+
+    def healthy(self) -> bool:
+        return all(st.state in ("running", "finished") for st in self.tasks.values())
+
+    async def stop(self, names=None):
+        selected = [st for name, st in self.tasks.items() if names is None or name in names]
+        tasks = [st.task for st in selected if st.task]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        for st in selected:
+            del self.tasks[st.name]
+
+
+supervisor = TaskSupervisor()
+
+
+class LoopMonitor:
+    # Корутина-проба міряє, наскільки пізніше запланованого прокидається sleep().
+    # Окремий потік-watchdog бачить, що проба давно не прокидалась, і логує стек
+    # коду, який саме зараз блокує event loop.
+
+    def __init__(self, interval: float, warn_ms: float):
+        self.interval = interval
+        self.warn_ms = warn_ms
+        self.last_ms = 0.0
+        self.samples: deque[tuple[float, float]] = deque(maxlen=max(1, int(60 / interval)))
+        self.heartbeat = 0.0
+        self.loop_thread_id: int | None = None
+        self._stop = threading.Event()
+
+    async def probe(self):
+        self.loop_thread_id = threading.get_ident()
+        self.heartbeat = time.monotonic()
+        while True:
+            t0 = time.monotonic()
+            await asyncio.sleep(self.interval)
+            now = time.monotonic()
+            self.heartbeat = now
+            self.last_ms = max(0.0, (now - t0 - self.interval) * 1000)
+            self.samples.append((now, self.last_ms))
+            if self.last_ms >= self.warn_ms:
+                log.warning("Event loop lag %.0f ms", self.last_ms)
+
+    def watchdog(self):
+        reported = False
+        while not self._stop.wait(self.interval):
+            # до першого тіку проби міряти нічого: старт (getMe, міграції,
+            # setWebhook) може тривати довше за поріг, а loop при цьому вільний
+            if not self.samples:
+                continue
+            stalled_ms = (time.monotonic() - self.heartbeat - self.interval) * 1000
+            if stalled_ms < self.warn_ms:
+                reported = False
+                continue
+            if reported or self.loop_thread_id is None:
+                continue
+            reported = True
+            frame = sys._current_frames().get(self.loop_thread_id)
+            stack = "".join(traceback.format_stack(frame)) if frame else "(no frame)"
+            log.warning("Event loop blocked for %.0f ms, current stack:\n%s", stalled_ms, stack)
+
+    def start_watchdog(self):
+        threading.Thread(target=self.watchdog, name="loop-watchdog", daemon=True).start()
+
+    def stop_watchdog(self):
+        self._stop.set()
+
+    def status(self) -> dict:
+        return {
+            "last_ms": round(self.last_ms, 2),
+            "max_1m_ms": round(max((ms for _, ms in self.samples), default=0.0), 2),
+        }
+
+
+loop_monitor = LoopMonitor(LOOP_LAG_INTERVAL, LOOP_LAG_WARN_MS)
+
+# Глибини черг для /health: ім'я → функція без I/O, що повертає розмір
+QUEUE_DEPTHS = {
+    "update_queue": lambda: telegram_app.update_queue.qsize(),
+    "events_buffer": lambda: len(event_log.buffer),
+    "polling_inflight": lambda: polling_inflight,
+    "recorder_buffer": lambda: len(recorder.buffer),
+    # pending — на момент останньої перевірки диспетчера
+    "outbox_pending": lambda: outbox.pending,
+    "outbox_inflight": lambda: outbox.inflight,
+    "scheduler_heap": lambda: len(scheduler.heap),
+}
+
+
+# ===================== OUTBOX =====================
+# Хендлери не шлють повідомлення напряму: намір надіслати пишеться в outbox
+# у тій самій транзакції (conn.transaction()), що й зміна стану (доступ,
+# подарунок, support_mode).
+# Диспетчер забирає рядки пачками, шле через send_limiter і повторює з backoff.
+# Доставка «щонайменше раз»: якщо процес впав посеред надсилання, рядок
+# повернеться в pending і піде ще раз.
+
+async def enqueue(conn, chat_id: int, kind: str, payload: dict, due: int | None = None):
+    # без commit — у transaction() того, хто викликає; після commit — outbox.wake()
+    now = int(time.time())
+    await conn.execute(
+        """
+        INSERT INTO outbox (kind, chat_id, payload, status, attempts, next_attempt_at, created_at)
+        VALUES (?, ?, ?, 'pending', 0, ?, ?)
+        """,
+        (kind, chat_id, json.dumps(payload, ensure_ascii=False), due or now, now)
+    )
+
+
+async def enqueue_message(conn, chat_id: int, text: str, reply_markup: InlineKeyboardMarkup | None = None,
+                          kind: str = "message"):
+    payload = {"text": text}
+    if reply_markup is not None:
+        payload["reply_markup"] = reply_markup.to_dict()
+    await enqueue(conn, chat_id, kind, payload)
+
+
+async def enqueue_access_link(conn, user_id: int, product: "Product", text: str):
+    # посилання створюється вже диспетчером; {link} у тексті підставляється тоді ж
+    await enqueue(conn, user_id, "access_link", {"product_id": product.id, "text": text})
+
+
+# скільки символів недоставленого тексту показати адміну (після html.escape
+# текст може вирости в кілька разів, а ліміт повідомлення — 4096)
+NOTIFY_TEXT_LIMIT = 500
+
+
+class Outbox:
+
+    # масові розсилки: недоставлене (бот заблокований, чат видалено) — норма,
+    # адміну не пишемо про кожне, лише підсумок у лог
+    QUIET_KINDS = {"drip"}
+
+    def __init__(self, batch: int, poll_interval: float, max_attempts: int,
+                 backoff_base: float, backoff_max: float, keep_days: float):
+        self.batch = batch
+        self.poll_interval = poll_interval
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.keep_seconds = int(keep_days * 86400)
+        self.pending = 0
+        self.inflight = 0
+        self._wakeup = asyncio.Event()
+        self._cleaned_at = 0.0
+
+    def wake(self):
+        self._wakeup.set()
+
+    async def recover(self):
+        # рядки, які забрали до падіння процесу, повертаємо в чергу
+        conn = await get_db()
+        async with conn.transaction():
+            cur = await conn.execute("UPDATE outbox SET status = 'pending' WHERE status = 'sending'")
+        if cur.rowcount:
+            log.warning("Outbox: %d interrupted messages returned to the queue", cur.rowcount)
+
+    async def claim(self) -> list:
+        conn = await get_db()
+        cur = await conn.execute(
+            """
+            SELECT id, kind, chat_id, payload, attempts, next_attempt_at
+            FROM outbox
+            WHERE status = 'pending' AND next_attempt_at <= ?
+            ORDER BY next_attempt_at, id
+            LIMIT ?
+            """,
+            (int(time.time()), self.batch)
+        )
+        rows = await cur.fetchall()
+        if rows:
+            async with conn.transaction():
+                await conn.executemany(
+                    "UPDATE outbox SET status = 'sending' WHERE id = ?",
+                    [(r["id"],) for r in rows]
+                )
+        return rows
+
+    async def send(self, row):
+        payload = json.loads(row["payload"])
+        await send_limiter.acquire()
+
+        if row["kind"] == "copy":
+            await telegram_app.bot.copy_message(
+                chat_id=row["chat_id"],
+                from_chat_id=payload["from_chat_id"],
+                message_id=payload["message_id"],
+                caption=payload.get("caption")
+            )
+            return
+
+        if row["kind"] == "album":
+            await telegram_app.bot.send_media_group(
+                chat_id=row["chat_id"],
+                media=[
+                    INPUT_MEDIA[item["type"]](media=item["file_id"], caption=item["caption"])
+                    for item in payload["media"]
+                ]
+            )
+            return
+
+        text = payload["text"]
+        if row["kind"] == "access_link":
+            link = payload.get("link")
+            if link is None:
+                product = get_product(payload["product_id"]) or default_product()
+                link = await create_invite_link(row["chat_id"], product)
+                # повтор після збою надсилання не створює нове посилання
+                payload["link"] = link
+                conn = await get_db()
+                async with conn.transaction():
+                    await conn.execute(
+                        "UPDATE outbox SET payload = ? WHERE id = ?",
+                        (json.dumps(payload, ensure_ascii=False), row["id"])
+                    )
+            text = text.replace("{link}", link)
+
+        markup = payload.get("reply_markup")
+        await telegram_app.bot.send_message(
+            chat_id=row["chat_id"],
+            text=text,
+            reply_markup=InlineKeyboardMarkup.de_json(markup, telegram_app.bot) if markup else None,
+            parse_mode="HTML"
+        )
+
+    def result(self, row, error: Exception | None, now: int, delay: float) -> tuple:
+        # → (status, attempts, next_attempt_at, sent_at, last_error, id)
+        attempts = row["attempts"] + 1
+        if error is None:
+            return ("sent", attempts, row["next_attempt_at"], now, None, row["id"])
+        if isinstance(error, RetryAfter):
+            # флуд-ліміт — не помилка повідомлення, спробу не рахуємо
+            return ("pending", row["attempts"], now + int(float(error.retry_after)) + 1, None, repr(error), row["id"])
+        if isinstance(error, (Forbidden, BadRequest)) or attempts >= self.max_attempts:
+            # бот заблокований / чат не існує — повтор не допоможе
+            return ("failed", attempts, now, None, repr(error), row["id"])
+        return ("pending", attempts, now + int(delay), None, repr(error), row["id"])
+
+    async def attempt(self, rows: list) -> list[tuple]:
+        # rows — одне повідомлення або текст одного дайджесту: успіх/помилка спільні
+        error = None
+        try:
+            if rows[0]["kind"] == "ticket":
+                await send_support_digest(rows)
+            else:
+                await self.send(rows[0])
+        except Exception as e:
+            error = e
+            if not isinstance(e, TelegramError):
+                log.exception("Outbox: unexpected error sending message %s", rows[0]["id"])
+
+        attempts = max(r["attempts"] for r in rows) + 1
+        delay = min(self.backoff_base * 2 ** (attempts - 1), self.backoff_max)
+        delay *= random.uniform(0.8, 1.2)
+        now = int(time.time())
+        return [self.result(row, error, now, delay) for row in rows]
+
+    async def deliver_chat(self, rows: list) -> list[tuple]:
+        # в один чат — по черзі, щоб зберегти порядок (звернення, потім медіа);
+        # звернення в режимі дайджесту об'єднуються в одне відправлення
+        units = [[r] for r in rows if r["kind"] != "ticket"]
+        units.extend(digest_units([r for r in rows if r["kind"] == "ticket"]))
+        units.sort(key=lambda unit: unit[0]["id"])
+
+        results = []
+        for i, unit in enumerate(units):
+            unit_results = await self.attempt(unit)
+            results.extend(unit_results)
+            if unit_results[0][0] == "pending":
+                # решту відкладаємо разом з першим невдалим, спробу не рахуємо
+                results.extend(
+                    ("pending", r["attempts"], unit_results[0][2], None, None, r["id"])
+                    for rest in units[i + 1:] for r in rest
+                )
+                break
+        return results
+
+    async def deliver(self, rows: list):
+        by_chat: dict[int, list] = {}
+        for row in rows:
+            by_chat.setdefault(row["chat_id"], []).append(row)
+
+        self.inflight = len(rows)
+        try:
+            groups = await asyncio.gather(*(self.deliver_chat(g) for g in by_chat.values()))
+        finally:
+            self.inflight = 0
+        results = [r for group in groups for r in group]
+
+        conn = await get_db()
+        async with conn.transaction():
+            await conn.executemany(
+                """
+                UPDATE outbox
+                SET status = ?, attempts = ?, next_attempt_at = ?, sent_at = ?, last_error = ?
+                WHERE id = ?
+                """,
+                results
+            )
+
+        failed = [r for r in results if r[0] == "failed"]
+        rows_by_id = {row["id"]: row for row in rows}
+        quiet = Counter()
+        for _, attempts, _, _, error, row_id in failed:
+            row = rows_by_id[row_id]
+            if row["kind"] in self.QUIET_KINDS:
+                quiet[row["kind"]] += 1
+                continue
+            log.warning("Outbox: message %s to %s failed after %d attempts: %s", row_id, row["chat_id"], attempts, error)
+            await self.notify_admin(row, error)
+        for kind, n in quiet.items():
+            log.info("Outbox: %d %s messages not delivered", n, kind)
+
+    @staticmethod
+    def describe(row) -> str:
+        # що саме не дійшло — щоб втрачене звернення можна було відновити вручну;
+        # текст екрануємо: він міг і бути причиною BadRequest
+        payload = json.loads(row["payload"])
+        if row["kind"] == "ticket":
+            return (
+                f"👤 Від: <code>{payload['user_id']}</code>\n"
+                f"📝 <code>{html.escape(payload['text'][:NOTIFY_TEXT_LIMIT])}</code>"
+            )
+        if "from_chat_id" in payload:
+            return f"📎 Повідомлення {payload['message_id']} з чату <code>{payload['from_chat_id']}</code>"
+        if "text" in payload:
+            # текст уже HTML — показуємо без розмітки
+            plain = html.unescape(re.sub(r"<[^>]+>", "", payload["text"]))
+            return f"<pre>{html.escape(plain[:NOTIFY_TEXT_LIMIT])}</pre>"
+        return ""
+
+    async def notify_admin(self, row, error: str):
+        # напряму, не через outbox — інакше збій міг би породжувати нові збої
+        try:
+            await telegram_app.bot.send_message(
+                chat_id=ADMIN_ID,
+                text=(
+                    "⚠️ <b>Не вдалося надіслати повідомлення</b>\n\n"
+                    f"👤 Чат: <code>{row['chat_id']}</code>\n"
+                    f"📦 Тип: {row['kind']}\n"
+                    f"❗️ {html.escape(str(error))}\n\n"
+                    + self.describe(row)
+                ),
+                parse_mode="HTML"
+            )
+        except Exception as e:
+            log.warning("Outbox: failed to notify admin about message %s: %r", row["id"], e)
+
+    async def idle_timeout(self) -> float:
+        conn = await get_db()
+        cur = await conn.execute(
+            "SELECT COUNT(*) AS n, MIN(next_attempt_at) AS next_at FROM outbox WHERE status = 'pending'"
+        )
+        row = await cur.fetchone()
+        self.pending = row["n"]
+        if row["next_at"] is None:
+            return self.poll_interval
+        return min(max(row["next_at"] - time.time(), 0.05), self.poll_interval)
+
+    async def cleanup(self):
+        # надіслані рядки тримаємо OUTBOX_KEEP_DAYS, failed — до ручного розбору
+        if time.monotonic() - self._cleaned_at < 3600:
+            return
+        self._cleaned_at = time.monotonic()
+        conn = await get_db()
+        async with conn.transaction():
+            cur = await conn.execute(
+                "DELETE FROM outbox WHERE status = 'sent' AND sent_at < ?",
+                (int(time.time()) - self.keep_seconds,)
+            )
+        if cur.rowcount:
+            log.info("Outbox: removed %d delivered messages", cur.rowcount)
+
+    async def run(self):
+        await self.recover()
+        while True:
+            # clear до claim: enqueue між claim і wait не загубить пробудження
+            self._wakeup.clear()
+            rows = await self.claim()
+            if rows:
+                await self.deliver(rows)
+                continue
+
+            await self.cleanup()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), await self.idle_timeout())
+            except asyncio.TimeoutError:
+                pass
+
+
+outbox = Outbox(
+    OUTBOX_BATCH, OUTBOX_POLL_INTERVAL, OUTBOX_MAX_ATTEMPTS,
+    OUTBOX_BACKOFF_BASE, OUTBOX_BACKOFF_MAX, OUTBOX_KEEP_DAYS,
+)
+
+
 # ===================== STARTUP =====================
 
+# фонові задачі, що працюють з БД: /restore зупиняє їх на час підміни файлу
+DB_TASKS = ("event_log", "outbox", "payment_reminders", "drip_lessons")
+
+
+def start_db_tasks():
+    supervisor.start("event_log", event_log.run)
+    supervisor.start("outbox", outbox.run)
+    if REMINDER_DELAYS:
+        supervisor.start("payment_reminders", payment_reminders_loop)
+    if DRIP_DELAYS:
+        supervisor.start("drip_lessons", scheduler.run)
+
+
 @app.on_event("startup")
 async def startup():
     await telegram_app.initialize()
     await telegram_app.start()
     await init_db()
-    asyncio.create_task(keep_alive())
+    await load_catalog()
+    instrument_handlers()
+    if INGESTION_MODE == "webhook" and WEBHOOK_BASE_URL:
+        try:
+            await register_webhook()
+        except TelegramError:
+            # бот працює і зі старою реєстрацією — не валимо старт
+            log.exception("Webhook registration failed")
+    supervisor.start("keep_alive", keep_alive)
+    supervisor.start("loop_monitor", loop_monitor.probe)
+    if RECORD_DIR:
+        supervisor.start("recorder", recorder.run)
+    start_db_tasks()
+    if BACKUP_INTERVAL_HOURS > 0:
+        supervisor.start("backups", backup_loop)
+    if INGESTION_MODE == "polling":
+        supervisor.start("polling", polling_loop)
+    loop_monitor.start_watchdog()
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    loop_monitor.stop_watchdog()
+    await supervisor.stop()
+    await event_log.flush()
+    if RECORD_DIR:
+        await recorder.flush()
+    await telegram_app.stop()
+    await telegram_app.shutdown()
+
+    global db
+    if db is not None:
+        await db.close()
+        db = None
+
+
+# ===================== WEBHOOK REGISTRATION =====================
+
+def allowed_updates() -> list[str]:
+    # лише ті типи апдейтів, які обробляють зареєстровані хендлери —
+    # решту Telegram навіть не надсилає
+    types = set()
+    for handlers in telegram_app.handlers.values():
+        for handler in handlers:
+            if isinstance(handler, CallbackQueryHandler):
+                types.add(Update.CALLBACK_QUERY)
+            elif isinstance(handler, ChatMemberHandler):
+                if handler.chat_member_types in (ChatMemberHandler.CHAT_MEMBER, ChatMemberHandler.ANY_CHAT_MEMBER):
+                    types.add(Update.CHAT_MEMBER)
+                if handler.chat_member_types in (ChatMemberHandler.MY_CHAT_MEMBER, ChatMemberHandler.ANY_CHAT_MEMBER):
+                    types.add(Update.MY_CHAT_MEMBER)
+            elif isinstance(handler, (CommandHandler, MessageHandler)):
+                types.add(Update.MESSAGE)
+            else:
+                # невідомий тип хендлера — краще отримувати все
+                return list(Update.ALL_TYPES)
+    return sorted(types)
+
+
+def secret_fingerprint() -> str:
+    # сам secret_token Telegram не повертає — пам'ятаємо хеш того, з яким реєстрували
+    return hashlib.sha256(WEBHOOK_SECRET.encode()).hexdigest()[:16]
+
+
+async def register_webhook():
+    bot = telegram_app.bot
+    url = f"{WEBHOOK_BASE_URL}/telegram/webhook/{WEBHOOK_TOKEN}"
+    wanted = allowed_updates()
+
+    info = await bot.get_webhook_info()
+    up_to_date = (
+        info.url == url
+        and sorted(info.allowed_updates or Update.ALL_TYPES) == sorted(wanted)
+        and info.max_connections == WEBHOOK_MAX_CONNECTIONS
+        and await get_state("webhook:secret") == secret_fingerprint()
+    )
+    if up_to_date and not WEBHOOK_DROP_PENDING:
+        log.info("Webhook is up to date (pending=%s)", info.pending_update_count)
+        return
+
+    await bot.set_webhook(
+        url=url,
+        allowed_updates=wanted,
+        max_connections=WEBHOOK_MAX_CONNECTIONS,
+        secret_token=WEBHOOK_SECRET or None,
+        drop_pending_updates=WEBHOOK_DROP_PENDING,
+    )
+    conn = await get_db()
+    async with conn.transaction():
+        await put_state(conn, "webhook:secret", secret_fingerprint())
+    log.info(
+        "Webhook registered: allowed_updates=%s max_connections=%s drop_pending=%s (was pending=%s)",
+        ",".join(wanted), WEBHOOK_MAX_CONNECTIONS, WEBHOOK_DROP_PENDING, info.pending_update_count
+    )
 
 
 # ===================== WEBHOOK ENDPOINT (ВАЖЛИВО) =====================
 
 @app.post("/telegram/webhook/{token}")
 async def telegram_webhook(token: str, request: Request):
-    if token != WEBHOOK_TOKEN:
+    # перевірки — до читання тіла; порівняння за сталий час
+    if WEBHOOK_SECRET and not secrets.compare_digest(
+        request.headers.get("x-telegram-bot-api-secret-token", "").encode(),
+        WEBHOOK_SECRET.encode(),
+    ):
+        raise HTTPException(status_code=403, detail="Invalid secret token")
+
+    # у режимі polling WEBHOOK_TOKEN може бути не задано — endpoint вимкнено
+    if not WEBHOOK_TOKEN:
+        raise HTTPException(status_code=404, detail="Webhook is not configured")
+
+    if not secrets.compare_digest(token.encode(), WEBHOOK_TOKEN.encode()):
         raise HTTPException(status_code=403, detail="Invalid token")
 
-    data = await request.json()
-    update = Update.de_json(data, telegram_app.bot)
-    await telegram_app.process_update(update)
+    started = time.perf_counter()
+    body = await request.body()
+    if RECORD_DIR:
+        recorder.add(body)
+    data = json.loads(body)
+    await dispatch_update(data, started)
     return {"ok": True}
 
 
+# /restore закриває прийом: нові апдейти чекають на intake_open, а
+# updates_inflight показує, скільки ще обробляються
+intake_open = asyncio.Event()
+intake_open.set()
+updates_inflight = 0
+
+
+async def dispatch_update(payload: dict | Update, started: float | None = None):
+    # Спільний шлях для webhook і long polling: трейс, парсинг, хендлери.
+    # payload — сирий JSON (webhook) або вже розібраний Update (getUpdates).
+    global updates_inflight
+    await intake_open.wait()
+
+    trace = Trace()
+    if started is not None:
+        trace.started = started
+
+    updates_inflight += 1
+    trace_token = current_trace.set(trace)
+    try:
+        if isinstance(payload, Update):
+            update = payload
+        else:
+            update = Update.de_json(payload, telegram_app.bot)
+        trace.spans["parse"] = (time.perf_counter() - trace.started) * 1000
+
+        trace.update_id = update.update_id
+        if update.effective_user:
+            trace.user_id = update.effective_user.id
+
+        t0 = time.perf_counter()
+        await telegram_app.process_update(update)
+        trace.spans["dispatch"] = (time.perf_counter() - t0) * 1000
+    except Exception as e:
+        trace.outcome = "error"
+        trace.error = repr(e)
+        raise
+    finally:
+        updates_inflight -= 1
+        current_trace.reset(trace_token)
+        finish_trace(trace)
+
+
+# ===================== LONG POLLING =====================
+
+polling_inflight = 0
+
+
+def update_order_key(update: Update) -> int:
+    # апдейти одного користувача обробляємо строго по черзі
+    if update.effective_user:
+        return update.effective_user.id
+    if update.effective_chat:
+        return update.effective_chat.id
+    return update.update_id
+
+
+async def dispatch_batch(updates: list[Update]):
+    global polling_inflight
+
+    groups: dict[int, list[Update]] = {}
+    for update in updates:
+        groups.setdefault(update_order_key(update), []).append(update)
+
+    sem = asyncio.Semaphore(POLL_CONCURRENCY)
+
+    async def run_group(group: list[Update]):
+        global polling_inflight
+        async with sem:
+            for update in group:
+                try:
+                    await dispatch_update(update)
+                except Exception:
+                    # один битий апдейт не повинен зупиняти пачку
+                    log.exception("Failed to process update %s", update.update_id)
+                finally:
+                    polling_inflight -= 1
+
+    polling_inflight += len(updates)
+    await asyncio.gather(*(run_group(g) for g in groups.values()))
+
+
+async def polling_loop():
+    bot = telegram_app.bot
+
+    # getUpdates не працює, поки встановлено webhook
+    await bot.delete_webhook(drop_pending_updates=False)
+
+    # offset переживає рестарт: вже оброблені апдейти не повторюються
+    offset = int(await get_state("polling:offset") or 0)
+    log.info("Long polling started (offset=%s)", offset)
+
+    while True:
+        try:
+            updates = await bot.get_updates(
+                offset=offset or None,
+                limit=POLL_LIMIT,
+                timeout=POLL_TIMEOUT,
+                read_timeout=POLL_TIMEOUT + 10,
+                allowed_updates=allowed_updates(),
+            )
+        except RetryAfter as e:
+            await asyncio.sleep(float(e.retry_after))
+            continue
+        except NetworkError as e:
+            log.warning("getUpdates failed: %r", e)
+            await asyncio.sleep(2)
+            continue
+
+        if not updates:
+            continue
+
+        await dispatch_batch(updates)
+
+        offset = updates[-1].update_id + 1
+        conn = await get_db()
+        async with conn.transaction():
+            await put_state(conn, "polling:offset", str(offset))
+
+
 # ===================== /start =====================
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -250,6 +1967,10 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # якщо користувач був у режимі "інше питання" — вимикаємо при /start
     await set_support_mode(user.id, 0)
 
+    # джерело переходу (напр. start=site) — для воронки
+    if args and not args[0].startswith(("paid", "gift_", "p_")):
+        context.user_data["source"] = args[0][:32]
+
     # ==================================================
     # === RETURN FROM GIFT LINK (отримувач подарунка) ===
     # ==================================================
@@ -257,7 +1978,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         gift_code = args[0].replace("gift_", "")
 
         cur = await conn.execute(
-            "SELECT id, is_used FROM gifts WHERE gift_code = ?",
+            "SELECT id, is_used, product_id FROM gifts WHERE gift_code = ?",
             (gift_code,)
         )
         gift = await cur.fetchone()
@@ -270,20 +1991,22 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await update.message.reply_text("⚠️ Цей подарунок вже був використаний.")
             return
 
-        link = await create_invite_link(user.id)
-        now = int(time.time())
+        product = get_product(gift["product_id"])
+        if not product:
+            await update.message.reply_text("❌ Цей подарунок недійсний.")
+            return
 
-        await conn.execute(
-            "UPDATE gifts SET is_used = 1, used_at = ? WHERE id = ?",
-            (now, gift["id"])
-        )
+        link = await create_invite_link(user.id, product)
+        now = int(time.time())
 
-        await conn.execute(
-            "UPDATE users SET has_access = 1 WHERE telegram_id = ?",
-            (user.id,)
-        )
+        async with conn.transaction():
+            await conn.execute(
+                "UPDATE gifts SET is_used = 1, used_at = ? WHERE id = ?",
+                (now, gift["id"])
+            )
 
-        await conn.commit()
+            await grant_access(conn, user.id, product, now)
+        track_event(context, user.id, "gift_redeemed", "gift")
 
         await update.message.reply_text(
             "🎉 <b>Подарунок активовано!</b>\n\n"
@@ -296,7 +2019,8 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # ======================================
     # === RETURN FROM PAYMENT (WayForPay) ===
     # ======================================
-    if args and args[0] == "paid":
+    # paid — продукт, який користувач обрав перед оплатою; paid_<id> — явно
+    if args and (args[0] == "paid" or args[0].startswith("paid_")):
         row = await get_user_row(user.id)
 
         if not row or row["awaiting_payment"] == 0:
@@ -307,8 +2031,13 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
             )
             return
 
+        if args[0].startswith("paid_"):
+            product = parse_product_arg(args[0][len("paid_"):]) or default_product()
+        else:
+            product = get_product(row["awaiting_product_id"]) or default_product()
+
         # захист від дублювання
-        if row["has_access"] == 1 and row["awaiting_payment_type"] == "self":
+        if row["awaiting_payment_type"] == "self" and product in await granted_products(user.id):
             await update.message.reply_text(
                 "✅ У Вас вже є доступ.\n\n"
                 "Якщо загубили посилання — натисніть ✉️ <b>Підтримка</b> → «Загубив посилання».",
@@ -318,110 +2047,109 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
         now = int(time.time())
 
-        # фіксуємо покупку (для /stats)
-        await conn.execute(
-            """
-            INSERT INTO purchases
-            (telegram_id, product_id, amount, currency, status, created_at, paid_at)
-            VALUES (?, ?, ?, ?, 'approved', ?, ?)
-            """,
-            (user.id, PRODUCT_ID, AMOUNT, CURRENCY, now, now)
-        )
-
-        # ==== GIFT FLOW: створюємо подарунок ТІЛЬКИ після paid ====
-        if row["awaiting_payment_type"] == "gift":
-            gift_code = await create_gift(user.id)
-
+        async with conn.transaction():
+            # фіксуємо покупку (для /stats)
             await conn.execute(
                 """
-                UPDATE users
-                SET awaiting_payment = 0,
-                    awaiting_payment_type = NULL,
-                    last_activity = ?
-                WHERE telegram_id = ?
+                INSERT INTO purchases
+                (telegram_id, product_id, amount, currency, status, created_at, paid_at)
+                VALUES (?, ?, ?, ?, 'approved', ?, ?)
                 """,
-                (now, user.id)
+                (user.id, product.id, product.amount, product.currency, now, now)
             )
-            await conn.commit()
 
-            # повідомлення №1 — покупцю
-            await update.message.reply_text(
-                "🎁 <b>Дякуємо за покупку подарунка!</b>\n\n"
-                "Ви придбали курс\n"
-                "<b>«Сам Собі Масажист»</b>\n"
-                "для близької людини 💙\n\n"
-                "⛔️ Будь ласка, не натискайте кнопку доступу самостійно.\n\n"
-                "👉 Перешліть наступне повідомлення людині, якій хочете зробити подарунок.",
-                parse_mode="HTML"
-            )
+            # ==== GIFT FLOW: створюємо подарунок ТІЛЬКИ після paid ====
+            if row["awaiting_payment_type"] == "gift":
+                gift_code = await insert_gift(conn, user.id, product)
+
+                await conn.execute(
+                    """
+                    UPDATE users
+                    SET awaiting_payment = 0,
+                        awaiting_payment_type = NULL,
+                        last_activity = ?
+                    WHERE telegram_id = ?
+                    """,
+                    (now, user.id)
+                )
 
-            # повідомлення №2 — для пересилання (ТВІЙ ТЕКСТ)
-            await update.message.reply_text(
-                "🎁 <b>Вам зробили подарунок!</b>\n\n"
-                "Для вас придбали курс\n"
-                "«Сам Собі Масажист» 💆‍♀️\n\n"
-                "Це курс, який допоможе:\n"
-                "• зняти напругу\n"
-                "• краще відчувати своє тіло\n"
-                "• піклуватися про себе щодня\n\n"
-                "Натисніть кнопку нижче,\n"
-                "щоб отримати доступ до курсу 👇",
-                reply_markup=InlineKeyboardMarkup([
-                    [InlineKeyboardButton(
-                        "🔓 Отримати доступ",
-                        url=f"https://t.me/{BOT_USERNAME}?start=gift_{gift_code}"
-                    )]
-                ]),
-                parse_mode="HTML"
-            )
-            return
+                # повідомлення №1 — покупцю
+                await enqueue_message(
+                    conn, user.id,
+                    "🎁 <b>Дякуємо за покупку подарунка!</b>\n\n"
+                    "Ви придбали курс\n"
+                    f"<b>«{course_title(product)}»</b>\n"
+                    "для близької людини 💙\n\n"
+                    "⛔️ Будь ласка, не натискайте кнопку доступу самостійно.\n\n"
+                    "👉 Перешліть наступне повідомлення людині, якій хочете зробити подарунок."
+                )
+
+                # повідомлення №2 — для пересилання (ТВІЙ ТЕКСТ)
+                await enqueue_message(conn, user.id, gift_text(product), gift_keyboard(gift_code))
+
+            # ==== SELF FLOW: доступ собі ====
+            else:
+                await conn.execute(
+                    """
+                    UPDATE users
+                    SET awaiting_payment = 0,
+                        awaiting_payment_type = NULL,
+                        last_activity = ?
+                    WHERE telegram_id = ?
+                    """,
+                    (now, user.id)
+                )
+                await grant_access(conn, user.id, product, now)
+                await enqueue_access_link(
+                    conn, user.id, product,
+                    "🎉 <b>Оплата успішна!</b>\n\n"
+                    "🔑 Ваш доступ:\n"
+                    "{link}"
+                )
+        track_event(context, user.id, "paid")
+        outbox.wake()
+        return
+
+    # ======================
+    # === NORMAL START ====
+    # ======================
+    # start=p_<id> — конкретний продукт з каталогу
+    product = None
+    if args and args[0].startswith("p_"):
+        product = parse_product_arg(args[0][len("p_"):])
+    product = product or default_product()
 
-        # ==== SELF FLOW: доступ собі ====
+    async with conn.transaction():
         await conn.execute(
             """
             UPDATE users
-            SET has_access = 1,
-                awaiting_payment = 0,
-                awaiting_payment_type = NULL,
+            SET awaiting_payment = 1,
+                awaiting_payment_type = 'self',
+                awaiting_product_id = ?,
                 last_activity = ?
             WHERE telegram_id = ?
             """,
-            (now, user.id)
+            (product.id, int(time.time()), user.id)
         )
-        await conn.commit()
-
-        link = await create_invite_link(user.id)
-
-        await update.message.reply_text(
-            "🎉 <b>Оплата успішна!</b>\n\n"
-            "🔑 Ваш доступ:\n"
-            f"{link}",
-            parse_mode="HTML"
-        )
-        return
-
-    # ======================
-    # === NORMAL START ====
-    # ======================
-    await conn.execute(
-        """
-        UPDATE users
-        SET awaiting_payment = 1,
-            awaiting_payment_type = 'self',
-            last_activity = ?
-        WHERE telegram_id = ?
-        """,
-        (int(time.time()), user.id)
-    )
-    await conn.commit()
+    track_event(context, user.id, "start", context.user_data.get("source", "direct"))
 
     keyboard = InlineKeyboardMarkup([
-        [InlineKeyboardButton("💳 Оплатити курс для себе", url=PAYMENT_BUTTON_URL)],
-        [InlineKeyboardButton("🎁 Купити курс в подарунок", callback_data="buy_gift")],
+        [InlineKeyboardButton("💳 Оплатити курс для себе", url=product.payment_url)],
+        [InlineKeyboardButton("🎁 Купити курс в подарунок", callback_data=f"buy_gift:{product.id}")],
         [InlineKeyboardButton("✉️ Написати в підтримку", callback_data="support:menu")]
     ])
 
-    if args and args[0] == "site":
+    if product.start_text:
+        txt = product.start_text
+    elif product.id != PRODUCT_ID:
+        txt = (
+            "Вітаю! 👋\n\n"
+            f"Тут ви можете придбати курс <b>«{product.name}»</b>:\n"
+            "• для себе\n"
+            "• або в подарунок близькій людині 🎁\n\n"
+            "Оберіть потрібний варіант нижче 👇"
+        )
+    elif args and args[0] == "site":
         txt = (
             "Вітаю! 👋\n\n"
             "Ви перейшли з сайту <b>Сам Собі Масажист</b>.\n\n"
@@ -456,6 +2184,7 @@ async def support_menu_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     user = q.from_user
     await upsert_user(user)
+    track_event(context, user.id, "support_open")
 
     kb = InlineKeyboardMarkup([
         [InlineKeyboardButton("❗ Не прийшло посилання на курс", callback_data="support:nolink")],
@@ -472,6 +2201,9 @@ async def support_menu_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 
 async def support_no_link_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if await throttled(update, "support_nolink"):
+        return
+
     q = update.callback_query
     await q.answer()
 
@@ -482,7 +2214,7 @@ async def support_no_link_cb(update: Update, context: ContextTypes.DEFAULT_TYPE)
 
     # Якщо доступ вже є — просто видаємо новий лінк (надійніше і швидше)
     if row and row["has_access"] == 1:
-        link = await create_invite_link(user.id)
+        link = await issue_access_links(user.id)
         await q.message.reply_text(
             "✅ Бачу, що доступ вже активний.\n\n"
             "🔑 Ось нове посилання:\n" + link,
@@ -509,6 +2241,9 @@ async def support_no_link_cb(update: Update, context: ContextTypes.DEFAULT_TYPE)
 
 
 async def support_lost_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if await throttled(update, "support_lost"):
+        return
+
     q = update.callback_query
     await q.answer()
 
@@ -518,7 +2253,7 @@ async def support_lost_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
     row = await get_user_row(user.id)
 
     if row and row["has_access"] == 1:
-        link = await create_invite_link(user.id)
+        link = await issue_access_links(user.id)
         await q.message.reply_text(
             "🔁 Оновив доступ.\n\n"
             "🔑 Ваше нове посилання:\n" + link,
@@ -540,6 +2275,7 @@ async def support_other_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await upsert_user(user)
 
     await set_support_mode(user.id, 1)
+    track_event(context, user.id, "support_other")
 
     await q.message.reply_text(
         "✍️ Напишіть Ваше питання одним повідомленням.\n\n"
@@ -557,6 +2293,9 @@ telegram_app.add_handler(CallbackQueryHandler(support_other_cb, pattern=r"^suppo
 # ===================== /access =====================
 
 async def access_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if await throttled(update, "access"):
+        return
+
     user = update.effective_user
     await upsert_user(user)
 
@@ -566,7 +2305,7 @@ async def access_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("❌ У Вас немає активного доступу.", parse_mode="HTML")
         return
 
-    link = await create_invite_link(user.id)
+    link = await issue_access_links(user.id)
     await update.message.reply_text("🔑 Ваш доступ:\n" + link, parse_mode="HTML")
 
 
@@ -579,55 +2318,333 @@ async def stats_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not is_admin(update):
         return
 
+    # /stats <product_id> — статистика одного продукту
+    product = None
+    if context.args:
+        product = get_product(int(context.args[0])) if context.args[0].isdigit() else None
+        if not product:
+            await update.message.reply_text("❌ Немає такого продукту.", parse_mode="HTML")
+            return
+
+    product_filter = " AND product_id = ?" if product else ""
+    product_params = (product.id,) if product else ()
+
     conn = await get_db()
     now = int(time.time())
 
     def since(days: int) -> int:
         return now - days * 86400
 
+    def money(rows) -> str:
+        # суми в різних валютах не складаємо
+        parts = [f"{round(r['s'], 2)} {r['currency']}" for r in rows if r["c"]]
+        return ", ".join(parts) if parts else f"0 {(product or default_product()).currency}"
+
     cur = await conn.execute("SELECT COUNT(*) AS c FROM users")
     total_users = (await cur.fetchone())["c"]
 
-    cur = await conn.execute("SELECT COUNT(*) AS c FROM purchases WHERE status='approved'")
+    cur = await conn.execute(
+        "SELECT COUNT(*) AS c FROM purchases WHERE status='approved'" + product_filter,
+        product_params
+    )
     total_paid = (await cur.fetchone())["c"]
 
-    cur = await conn.execute("SELECT COALESCE(SUM(amount),0) AS s FROM purchases WHERE status='approved'")
-    total_revenue = (await cur.fetchone())["s"]
+    cur = await conn.execute(
+        "SELECT currency, COUNT(*) AS c, COALESCE(SUM(amount),0) AS s FROM purchases "
+        "WHERE status='approved'" + product_filter + " GROUP BY currency",
+        product_params
+    )
+    total_revenue = money(await cur.fetchall())
 
     async def period_stats(days: int):
         cur = await conn.execute("""
-            SELECT COUNT(*) AS c, COALESCE(SUM(amount),0) AS s
+            SELECT currency, COUNT(*) AS c, COALESCE(SUM(amount),0) AS s
             FROM purchases
-            WHERE status='approved' AND paid_at >= ?
-        """, (since(days),))
-        row = await cur.fetchone()
-        return row["c"], row["s"]
+            WHERE status='approved' AND paid_at >= ?""" + product_filter + """
+            GROUP BY currency
+        """, (since(days), *product_params))
+        rows = await cur.fetchall()
+        return sum(r["c"] for r in rows), money(rows)
 
     day_c, day_s = await period_stats(1)
     week_c, week_s = await period_stats(7)
     month_c, month_s = await period_stats(30)
     q_c, q_s = await period_stats(90)
 
+    title = f"<b>Статистика: {product.name}</b>" if product else "<b>Статистика бота</b>"
+
     txt = (
-        "<b>Статистика бота</b>\n\n"
+        f"{title}\n\n"
         f"👥 Усього користувачів: <b>{total_users}</b>\n"
         f"💳 Усього покупців: <b>{total_paid}</b>\n"
-        f"💰 Загальний дохід: <b>{round(total_revenue, 2)} UAH</b>\n\n"
+        f"💰 Загальний дохід: <b>{total_revenue}</b>\n\n"
         "<b>Продажі по періодах:</b>\n"
-        f"📅 За 24 години: <b>{day_c}</b> купівель – <b>{round(day_s, 2)} UAH</b>\n"
-        f"📆 За 7 днів: <b>{week_c}</b> купівель – <b>{round(week_s, 2)} UAH</b>\n"
-        f"🗓 За 30 днів: <b>{month_c}</b> купівель – <b>{round(month_s, 2)} UAH</b>\n"
-        f"📈 За 90 днів: <b>{q_c}</b> купівель – <b>{round(q_s, 2)} UAH</b>\n"
+        f"📅 За 24 години: <b>{day_c}</b> купівель – <b>{day_s}</b>\n"
+        f"📆 За 7 днів: <b>{week_c}</b> купівель – <b>{week_s}</b>\n"
+        f"🗓 За 30 днів: <b>{month_c}</b> купівель – <b>{month_s}</b>\n"
+        f"📈 За 90 днів: <b>{q_c}</b> купівель – <b>{q_s}</b>\n"
     )
 
+    # розбивка по продуктах, якщо їх більше одного
+    if not product and len(catalog.products) > 1:
+        cur = await conn.execute("""
+            SELECT product_id, currency, COUNT(*) AS c, COALESCE(SUM(amount),0) AS s
+            FROM purchases
+            WHERE status='approved'
+            GROUP BY product_id, currency
+            ORDER BY product_id
+        """)
+        lines = []
+        for r in await cur.fetchall():
+            p = get_product(r["product_id"])
+            name = p.name if p else f"#{r['product_id']}"
+            lines.append(f"• {name}: <b>{r['c']}</b> – <b>{round(r['s'], 2)} {r['currency']}</b>")
+        if lines:
+            txt += "\n<b>По продуктах:</b>\n" + "\n".join(lines) + "\n"
+
     await update.message.reply_text(txt, parse_mode="HTML")
 
 
 telegram_app.add_handler(CommandHandler("stats", stats_cmd))
 
 
+# ===================== /funnel =====================
+
+FUNNEL_STEPS = [
+    ("buy_gift", "🎁 Натиснули «подарунок»"),
+    ("support_open", "🆘 Відкрили підтримку"),
+    ("paid", "💳 Оплатили"),
+]
+
+
+async def funnel_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not is_admin(update):
+        return
+
+    try:
+        days = max(1, int(context.args[0])) if context.args else 7
+    except ValueError:
+        await update.message.reply_text("Використання: <code>/funnel [днів]</code>", parse_mode="HTML")
+        return
+
+    # щоб бачити і події за останні секунди
+    await event_log.flush()
+
+    conn = await get_db()
+    since = int(time.time()) - days * 86400
+
+    # усі запити — діапазон по idx_events_event_ts (event, ts, telegram_id, source)
+    cur = await conn.execute(
+        "SELECT COUNT(DISTINCT telegram_id) AS c FROM events WHERE event = 'start' AND ts >= ?",
+        (since,)
+    )
+    started = (await cur.fetchone())["c"]
+
+    def pct(n: int, base: int) -> str:
+        return f"{n * 100 / base:.1f}%" if base else "—"
+
+    lines = [
+        f"<b>Воронка за {days} дн.</b>\n",
+        f"👋 /start: <b>{started}</b>",
+    ]
+
+    prev = started
+
+    for event, title in FUNNEL_STEPS:
+        cur = await conn.execute(
+            """
+            SELECT COUNT(DISTINCT telegram_id) AS c
+            FROM events
+            WHERE event = ? AND ts >= ?
+              AND telegram_id IN (
+                  SELECT telegram_id FROM events WHERE event = 'start' AND ts >= ?
+              )
+            """,
+            (event, since, since)
+        )
+        n = (await cur.fetchone())["c"]
+        lines.append(f"{title}: <b>{n}</b> ({pct(n, started)} від /start, {pct(n, prev)} від попереднього кроку)")
+        prev = n
+
+    # джерело користувача — з його першого start у періоді: SQLite бере source
+    # з рядка з MIN(...). Source у подальших подіях після рестарту порожній.
+    # Один прохід по індексу для start і paid разом.
+    cur = await conn.execute(
+        """
+        SELECT source, COUNT(*) AS started, SUM(paid_events > 0) AS paid
+        FROM (
+            SELECT COALESCE(source, 'direct') AS source,
+                   MIN(CASE WHEN event = 'start' THEN ts ELSE 9e18 END) AS first_start,
+                   SUM(event = 'paid') AS paid_events
+            FROM events
+            WHERE event IN ('start', 'paid') AND ts >= ?
+            GROUP BY telegram_id
+        )
+        WHERE first_start < 9e18
+        GROUP BY source
+        ORDER BY started DESC
+        """,
+        (since,)
+    )
+    rows = await cur.fetchall()
+
+    if rows:
+        lines.append("\n<b>Джерела (start → paid):</b>")
+        for row in rows:
+            lines.append(f"• {row['source']}: {row['started']} → {row['paid']} ({pct(row['paid'], row['started'])})")
+
+    await update.message.reply_text("\n".join(lines), parse_mode="HTML")
+
+
+telegram_app.add_handler(CommandHandler("funnel", funnel_cmd))
+
+
+# ===================== /reload_catalog =====================
+
+async def reload_catalog_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not is_admin(update):
+        return
+
+    snap = await load_catalog()
+
+    lines = [f"🔄 <b>Каталог оновлено</b> ({len(snap.products)})"]
+    for p in snap.products.values():
+        status = "✅" if p.is_active else "⏸"
+        default = " (за замовчуванням)" if p.id == snap.default_id else ""
+        lines.append(
+            f"{status} <b>{p.id}</b> — {p.name}{default}\n"
+            f"💰 {p.amount} {p.currency} · канал <code>{p.channel_id}</code>\n"
+            f"🔗 <code>https://t.me/{BOT_USERNAME}?start=p_{p.id}</code>"
+        )
+
+    await update.message.reply_text("\n\n".join(lines), parse_mode="HTML")
+
+
+telegram_app.add_handler(CommandHandler("reload_catalog", reload_catalog_cmd))
+
+
 # ===================== SUPPORT: USER TEXT FORWARDING =====================
 
+# альбом (sendMediaGroup) може містити фото разом з відео, але документи й аудіо —
+# лише з такими ж; голосові в альбом не входять і копіюються окремо
+SUPPORT_MEDIA_ALBUMS = {"photo": "visual", "video": "visual", "document": "document", "audio": "audio"}
+INPUT_MEDIA = {
+    "photo": InputMediaPhoto,
+    "video": InputMediaVideo,
+    "document": InputMediaDocument,
+    "audio": InputMediaAudio,
+}
+MEDIA_LABELS = {"photo": "фото", "video": "відео", "document": "файл", "audio": "аудіо", "voice": "голосове"}
+DIGEST_TEXT_LIMIT = 3500  # ліміт Telegram — 4096 символів на повідомлення
+
+
+def message_media(message) -> dict | None:
+    if message.photo:
+        return {"type": "photo", "file_id": message.photo[-1].file_id}
+    for kind in ("video", "document", "audio", "voice"):
+        attachment = getattr(message, kind)
+        if attachment:
+            return {"type": kind, "file_id": attachment.file_id}
+    return None
+
+
+def digest_entry(ticket_id: int, ticket: dict) -> str:
+    text = ticket["text"]
+    if len(text) > DIGEST_TEXT_LIMIT - 500:
+        text = text[:DIGEST_TEXT_LIMIT - 500] + "…"
+    lines = [
+        f"<b>#{ticket_id}</b> 👤 <code>{ticket['user_id']}</code> · "
+        f"@{html.escape(ticket['username'] or 'немає')} · <b>{html.escape(ticket['first_name'] or '')}</b>",
+        f"📝 <code>{html.escape(text)}</code>",
+    ]
+    if ticket["media"]:
+        lines.append(f"📎 {MEDIA_LABELS[ticket['media']['type']]} — нижче з підписом #{ticket_id}")
+    return "\n".join(lines)
+
+
+def digest_units(rows: list) -> list[list]:
+    # звернення одного чату → порції, кожна вміщується в одне текстове повідомлення
+    units, current, size = [], [], 0
+    for row in rows:
+        entry_size = len(digest_entry(row["id"], json.loads(row["payload"])))
+        if current and (len(current) >= SUPPORT_DIGEST_MAX_TICKETS or size + entry_size > DIGEST_TEXT_LIMIT):
+            units.append(current)
+            current, size = [], 0
+        current.append(row)
+        size += entry_size + 2
+    if current:
+        units.append(current)
+    return units
+
+
+async def send_support_digest(rows: list):
+    # Порція звернень (digest_units): один текст з кнопками для кожного звернення.
+    # Медіа після успішного тексту стають окремими рядками outbox (альбоми й
+    # копії), тож збій медіа не повторює текст. Викликає outbox-диспетчер.
+    tickets = [(row["id"], json.loads(row["payload"])) for row in rows]
+
+    await send_limiter.acquire()
+    await telegram_app.bot.send_message(
+        chat_id=SUPPORT_CHAT_ID,
+        text=f"💬 <b>Нові звернення в підтримку: {len(tickets)}</b>\n\n"
+             + "\n\n".join(digest_entry(ticket_id, ticket) for ticket_id, ticket in tickets),
+        reply_markup=InlineKeyboardMarkup([
+            [
+                InlineKeyboardButton(
+                    f"✅ Доступ #{ticket_id}",
+                    callback_data=f"admin:grant:{ticket['user_id']}:{ticket['product_id']}"
+                ),
+                InlineKeyboardButton(
+                    f"🎁 Подарунок #{ticket_id}",
+                    callback_data=f"admin:gift:{ticket['user_id']}:{ticket['product_id']}"
+                )
+            ]
+            for ticket_id, ticket in tickets
+        ]),
+        parse_mode="HTML"
+    )
+
+    # статус самих звернень фіксує Outbox.deliver; впадемо між ними — текст
+    # піде повторно (доставка «щонайменше раз»), медіа не загубляться
+    conn = await get_db()
+    async with conn.transaction():
+        await enqueue_digest_media(conn, tickets)
+
+
+async def enqueue_digest_media(conn, tickets: list[tuple[int, dict]]):
+    albums: dict[str, list] = {}
+    singles = []
+    for ticket_id, ticket in tickets:
+        media = ticket["media"]
+        if not media:
+            continue
+        album = SUPPORT_MEDIA_ALBUMS.get(media["type"])
+        if album:
+            albums.setdefault(album, []).append((ticket_id, ticket))
+        else:
+            singles.append((ticket_id, ticket))
+
+    for items in albums.values():
+        for i in range(0, len(items), 10):
+            part = items[i:i + 10]
+            if len(part) == 1:
+                singles.append(part[0])
+                continue
+            await enqueue(conn, SUPPORT_CHAT_ID, "album", {
+                "media": [
+                    {"type": ticket["media"]["type"], "file_id": ticket["media"]["file_id"], "caption": f"#{ticket_id}"}
+                    for ticket_id, ticket in part
+                ],
+            })
+
+    for ticket_id, ticket in sorted(singles, key=lambda item: item[0]):
+        await enqueue(conn, SUPPORT_CHAT_ID, "copy", {
+            "from_chat_id": ticket["from_chat_id"],
+            "message_id": ticket["message_id"],
+            "caption": f"#{ticket_id}",
+        })
+
+
 async def user_messages(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not update.message:
         return
@@ -657,58 +2674,76 @@ async def user_messages(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     text = update.message.text or update.message.caption or "(медіа без тексту)"
+    product = get_product(row["awaiting_product_id"]) or default_product()
 
-    try:
-        await telegram_app.bot.send_message(
-            chat_id=SUPPORT_CHAT_ID,
-            text=(
-                "💬 <b>Нове звернення в підтримку</b>\n\n"
-                f"👤 ID: <code>{user.id}</code>\n"
-                f"🔗 Username: @{user.username if user.username else 'немає'}\n"
-                f"🙍‍♀️ Ім'я: <b>{user.first_name}</b>\n\n"
-                f"📝 Текст:\n<code>{text}</code>"
-            ),
-            reply_markup=InlineKeyboardMarkup([
-                [
-                    InlineKeyboardButton(
-                        "✅ Видати доступ",
-                        callback_data=f"admin:grant:{user.id}"
-                    ),
-                    InlineKeyboardButton(
-                        "🎁 Видати подарунок",
-                        callback_data=f"admin:gift:{user.id}"
-                    )
-                ]
-            ]),
-            parse_mode="HTML"
-        )
-
-        # якщо це медіа — копіюємо
-        if update.message.photo or update.message.video or update.message.document or update.message.audio or update.message.voice:
-            await telegram_app.bot.copy_message(
-                chat_id=SUPPORT_CHAT_ID,
-                from_chat_id=update.effective_chat.id,
-                message_id=update.message.message_id
-            )
+    conn = await get_db()
+    try:
+        async with conn.transaction():
+            if SUPPORT_DIGEST_WINDOW:
+                # чекає кінця поточного вікна і піде одним дайджестом з іншими
+                due = (int(time.time()) // SUPPORT_DIGEST_WINDOW + 1) * SUPPORT_DIGEST_WINDOW
+                await enqueue(conn, SUPPORT_CHAT_ID, "ticket", {
+                    "user_id": user.id,
+                    "username": user.username,
+                    "first_name": user.first_name,
+                    "text": text,
+                    "product_id": product.id,
+                    "media": message_media(update.message),
+                    "from_chat_id": update.effective_chat.id,
+                    "message_id": update.message.message_id,
+                }, due=due)
+            else:
+                await enqueue_message(
+                    conn, SUPPORT_CHAT_ID,
+                    "💬 <b>Нове звернення в підтримку</b>\n\n"
+                    f"👤 ID: <code>{user.id}</code>\n"
+                    f"🔗 Username: @{user.username if user.username else 'немає'}\n"
+                    f"🙍‍♀️ Ім'я: <b>{html.escape(user.first_name or '')}</b>\n\n"
+                    f"📝 Текст:\n<code>{html.escape(text)}</code>",
+                    InlineKeyboardMarkup([
+                        [
+                            InlineKeyboardButton(
+                                "✅ Видати доступ",
+                                callback_data=f"admin:grant:{user.id}:{product.id}"
+                            ),
+                            InlineKeyboardButton(
+                                "🎁 Видати подарунок",
+                                callback_data=f"admin:gift:{user.id}:{product.id}"
+                            )
+                        ]
+                    ])
+                )
 
-        await update.message.reply_text(
-            "✅ Дякую! Передав у підтримку. Скоро Вам дадуть відповідь 🙏",
-            parse_mode="HTML"
-        )
+                # якщо це медіа — копіюємо
+                if message_media(update.message):
+                    await enqueue(conn, SUPPORT_CHAT_ID, "copy", {
+                        "from_chat_id": update.effective_chat.id,
+                        "message_id": update.message.message_id,
+                    })
 
-        # Вимикаємо режим після одного звернення (щоб не спамило)
-        await set_support_mode(user.id, 0)
+            # Вимикаємо режим після одного звернення (щоб не спамило)
+            await conn.execute("UPDATE users SET support_mode = 0 WHERE telegram_id = ?", (user.id,))
 
     except Exception:
-        # якщо не вдалось відправити в SUPPORT_CHAT_ID
+        # якщо не вдалось записати звернення в outbox
+        log.exception("Failed to queue support message from %s", user.id)
         await update.message.reply_text(
             "❌ Не вдалося передати повідомлення в підтримку.\n"
             "Спробуйте ще раз або напишіть пізніше.",
             parse_mode="HTML"
         )
+        return
+
+    outbox.wake()
+    await update.message.reply_text(
+        "✅ Дякую! Передав у підтримку. Скоро Вам дадуть відповідь 🙏",
+        parse_mode="HTML"
+    )
 
 
-telegram_app.add_handler(MessageHandler(filters.ALL, user_messages))
+# команди не чіпаємо — інакше цей хендлер перехопив би всі команди,
+# зареєстровані нижче (/grant_bulk, /gift_bulk, ...)
+telegram_app.add_handler(MessageHandler(filters.ALL & ~filters.COMMAND, user_messages))
 
 
 # ===================== GIFT CALLBACK =====================
@@ -720,20 +2755,26 @@ async def gift_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = query.from_user
     await upsert_user(user)
 
+    # buy_gift:<product_id>; старі кнопки без id — продукт за замовчуванням
+    _, _, product_arg = query.data.partition(":")
+    product = parse_product_arg(product_arg) or default_product()
+
     conn = await get_db()
 
     # 🔐 позначаємо, що користувач іде на оплату ПОДАРУНКА
-    await conn.execute(
-        """
-        UPDATE users
-        SET awaiting_payment = 1,
-            awaiting_payment_type = 'gift',
-            last_activity = ?
-        WHERE telegram_id = ?
-        """,
-        (int(time.time()), user.id)
-    )
-    await conn.commit()
+    async with conn.transaction():
+        await conn.execute(
+            """
+            UPDATE users
+            SET awaiting_payment = 1,
+                awaiting_payment_type = 'gift',
+                awaiting_product_id = ?,
+                last_activity = ?
+            WHERE telegram_id = ?
+            """,
+            (product.id, int(time.time()), user.id)
+        )
+    track_event(context, user.id, "buy_gift")
 
     # 👉 просто відправляємо на WayForPay
     await query.message.reply_text(
@@ -744,7 +2785,7 @@ async def gift_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         reply_markup=InlineKeyboardMarkup([
             [InlineKeyboardButton(
                 "💳 Перейти до оплати подарунка",
-                url=PAYMENT_BUTTON_URL
+                url=product.payment_url
             )]
         ]),
         parse_mode="HTML"
@@ -752,7 +2793,7 @@ async def gift_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 
 telegram_app.add_handler(
-    CallbackQueryHandler(gift_callback, pattern="^buy_gift$")
+    CallbackQueryHandler(gift_callback, pattern=r"^buy_gift(:\d+)?$")
 )
 
 
@@ -767,33 +2808,32 @@ async def admin_grant_access_cb(update: Update, context: ContextTypes.DEFAULT_TY
         await query.answer("⛔️ Немає доступу", show_alert=True)
         return
 
-    user_id = int(query.data.split(":")[2])
+    # admin:grant:<user_id>[:<product_id>]
+    parts = query.data.split(":")
+    user_id = int(parts[2])
+    product = get_product(int(parts[3]) if len(parts) > 3 else None) or default_product()
     conn = await get_db()
 
-    await conn.execute(
-        """
-        UPDATE users
-        SET has_access = 1,
-            awaiting_payment = 0,
-            awaiting_payment_type = NULL
-        WHERE telegram_id = ?
-        """,
-        (user_id,)
-    )
-    await conn.commit()
-
-    link = await create_invite_link(user_id)
+    async with conn.transaction():
+        await conn.execute(
+            """
+            UPDATE users
+            SET awaiting_payment = 0,
+                awaiting_payment_type = NULL
+            WHERE telegram_id = ?
+            """,
+            (user_id,)
+        )
+        await grant_access(conn, user_id, product, int(time.time()))
 
-    # повідомлення користувачу
-    await telegram_app.bot.send_message(
-        chat_id=user_id,
-        text=(
+        # повідомлення користувачу — через outbox, у тій самій транзакції
+        await enqueue_access_link(
+            conn, user_id, product,
             "🎉 <b>Доступ активовано!</b>\n\n"
             "Ось ваше персональне посилання до курсу:\n"
-            f"{link}"
-        ),
-        parse_mode="HTML"
-    )
+            "{link}"
+        )
+    outbox.wake()
 
     # підтвердження в чат підтримки
     await query.message.reply_text(
@@ -818,10 +2858,13 @@ async def admin_grant_gift_cb(update: Update, context: ContextTypes.DEFAULT_TYPE
         await query.answer("⛔️ Немає доступу", show_alert=True)
         return
 
-    buyer_id = int(query.data.split(":")[2])
+    # admin:gift:<user_id>[:<product_id>]
+    parts = query.data.split(":")
+    buyer_id = int(parts[2])
+    product = get_product(int(parts[3]) if len(parts) > 3 else None) or default_product()
 
     # створюємо подарунок
-    gift_code = await create_gift(buyer_id)
+    gift_code = await create_gift(buyer_id, product)
 
     # повідомлення №1 — адмінам (пояснення + КНОПКА)
     await query.message.reply_text(
@@ -840,23 +2883,8 @@ async def admin_grant_gift_cb(update: Update, context: ContextTypes.DEFAULT_TYPE
 
     # повідомлення №2 — ГОТОВЕ ДЛЯ ПЕРЕСИЛАННЯ (як резерв)
     await query.message.reply_text(
-        "🎁 <b>Вам зробили подарунок!</b>\n\n"
-        "Для вас придбали курс\n"
-        "«Сам Собі Масажист» 💆‍♀️\n\n"
-        "Це курс, який допоможе:\n"
-        "• зняти напругу\n"
-        "• краще відчувати своє тіло\n"
-        "• піклуватися про себе щодня\n\n"
-        "Натисніть кнопку нижче,\n"
-        "щоб отримати доступ до курсу 👇",
-        reply_markup=InlineKeyboardMarkup([
-            [
-                InlineKeyboardButton(
-                    "🔓 Отримати доступ",
-                    url=f"https://t.me/{BOT_USERNAME}?start=gift_{gift_code}"
-                )
-            ]
-        ]),
+        gift_text(product),
+        reply_markup=gift_keyboard(gift_code),
         parse_mode="HTML"
     )
 
@@ -880,30 +2908,16 @@ async def admin_send_gift_to_client_cb(update: Update, context: ContextTypes.DEF
     _, _, buyer_id, gift_code = query.data.split(":")
     buyer_id = int(buyer_id)
 
+    # продукт подарунка зберігається разом з кодом
+    conn = await get_db()
+    cur = await conn.execute("SELECT product_id FROM gifts WHERE gift_code = ?", (gift_code,))
+    gift = await cur.fetchone()
+    product = get_product(gift["product_id"] if gift else None) or default_product()
+
     # повідомлення клієнту
-    await context.bot.send_message(
-        chat_id=buyer_id,
-        text=(
-            "🎁 <b>Вам зробили подарунок!</b>\n\n"
-            "Для вас придбали курс\n"
-            "«Сам Собі Масажист» 💆‍♀️\n\n"
-            "Це курс, який допоможе:\n"
-            "• зняти напругу\n"
-            "• краще відчувати своє тіло\n"
-            "• піклуватися про себе щодня\n\n"
-            "Натисніть кнопку нижче,\n"
-            "щоб отримати доступ до курсу 👇"
-        ),
-        reply_markup=InlineKeyboardMarkup([
-            [
-                InlineKeyboardButton(
-                    "🔓 Отримати доступ",
-                    url=f"https://t.me/{BOT_USERNAME}?start=gift_{gift_code}"
-                )
-            ]
-        ]),
-        parse_mode="HTML"
-    )
+    async with conn.transaction():
+        await enqueue_message(conn, buyer_id, gift_text(product), gift_keyboard(gift_code))
+    outbox.wake()
 
     # підтвердження адміну
     await query.message.reply_text(
@@ -920,10 +2934,813 @@ telegram_app.add_handler(
 )
 
 
+# ===================== BULK: /grant_bulk, /gift_bulk =====================
+
+BULK_USAGE = (
+    "Використання:\n"
+    "<code>/grant_bulk 111 222 333</code>\n"
+    "<code>/gift_bulk 111,222,333</code>\n\n"
+    "Або надішліть CSV-файл (ID у першій колонці) і дайте на нього відповідь командою.\n"
+    "Інший продукт: <code>product=2</code> серед аргументів."
+)
+
+
+def bulk_product(context: ContextTypes.DEFAULT_TYPE) -> Product | None:
+    for arg in context.args or []:
+        if arg.startswith("product="):
+            return parse_product_arg(arg[len("product="):])
+    return default_product()
+
+
+async def read_bulk_ids(update: Update, context: ContextTypes.DEFAULT_TYPE) -> tuple[list[int], list[str]]:
+    tokens = [arg for arg in context.args or [] if not arg.startswith("product=")]
+
+    # CSV-файл: адмін відповідає командою на повідомлення з документом
+    reply = update.message.reply_to_message
+    if reply and reply.document:
+        tg_file = await reply.document.get_file()
+        data = await tg_file.download_as_bytearray()
+        text = bytes(data).decode("utf-8-sig", errors="replace")
+
+        for i, row in enumerate(csv.reader(io.StringIO(text))):
+            if not row or not row[0].strip():
+                continue
+            # заголовок на кшталт "telegram_id" пропускаємо
+            if i == 0 and not row[0].strip().lstrip("-").isdigit():
+                continue
+            tokens.append(row[0])
+
+    ids: list[int] = []
+    invalid: list[str] = []
+    seen = set()
+
+    for token in tokens:
+        for part in token.replace(";", ",").split(","):
+            part = part.strip()
+            if not part:
+                continue
+            if not part.lstrip("-").isdigit():
+                invalid.append(part)
+                continue
+            uid = int(part)
+            if uid not in seen:
+                seen.add(uid)
+                ids.append(uid)
+
+    return ids, invalid
+
+
+async def with_retry(call, attempts: int = 3):
+    # Telegram може відповісти 429 (RetryAfter) — чекаємо і пробуємо ще раз
+    for attempt in range(attempts):
+        try:
+            return await call()
+        except RetryAfter as e:
+            if attempt == attempts - 1:
+                raise
+            await asyncio.sleep(float(e.retry_after))
+
+
+async def send_bulk_report(update: Update, name: str, rows: list[tuple], summary: str):
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    writer.writerow(["telegram_id", "status", "detail", "value"])
+    writer.writerows(rows)
+
+    await update.message.reply_document(
+        document=buf.getvalue().encode("utf-8"),
+        filename=f"{name}_report_{int(time.time())}.csv",
+        caption=summary,
+        parse_mode="HTML"
+    )
+
+
+def bulk_summary(title: str, rows: list[tuple], started: float) -> str:
+    ok = sum(1 for r in rows if r[1] == "ok")
+    return (
+        f"{title}\n\n"
+        f"✅ Успішно: <b>{ok}</b>\n"
+        f"❌ З помилками: <b>{len(rows) - ok}</b>\n"
+        f"⏱ {time.monotonic() - started:.1f} с"
+    )
+
+
+async def admin_grant_bulk_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not is_admin(update):
+        return
+
+    ids, invalid = await read_bulk_ids(update, context)
+    product = bulk_product(context)
+    if not ids or not product:
+        await update.message.reply_text(BULK_USAGE, parse_mode="HTML")
+        return
+
+    started = time.monotonic()
+    await update.message.reply_text(f"⏳ Видаю доступ: <b>{len(ids)}</b> користувачів…", parse_mode="HTML")
+
+    conn = await get_db()
+    now = int(time.time())
+
+    # одна транзакція на всю пачку
+    async with conn.transaction():
+        await conn.executemany(
+            """
+            INSERT OR IGNORE INTO users
+            (telegram_id, joined_at, last_activity, has_access, awaiting_payment, awaiting_payment_type, support_mode)
+            VALUES (?, ?, ?, 0, 0, NULL, 0)
+            """,
+            [(uid, now, now) for uid in ids]
+        )
+        await conn.executemany(
+            """
+            UPDATE users
+            SET has_access = 1,
+                awaiting_payment = 0,
+                awaiting_payment_type = NULL
+            WHERE telegram_id = ?
+            """,
+            [(uid,) for uid in ids]
+        )
+        await conn.executemany(
+            "INSERT OR IGNORE INTO access_grants (telegram_id, product_id, granted_at) VALUES (?, ?, ?)",
+            [(uid, product.id, now) for uid in ids]
+        )
+        await schedule_drip(conn, ids, product, now)
+
+    sem = asyncio.Semaphore(BULK_CONCURRENCY)
+
+    async def grant_one(uid: int) -> tuple:
+        async with sem:
+            try:
+                link = await with_retry(lambda: request_invite_link(product))
+            except TelegramError as e:
+                return (uid, "error", f"invite link: {e}", "")
+
+            try:
+                await with_retry(lambda: telegram_app.bot.send_message(
+                    chat_id=uid,
+                    text=(
+                        "🎉 <b>Доступ активовано!</b>\n\n"
+                        "Ось ваше персональне посилання до курсу:\n"
+                        f"{link}"
+                    ),
+                    parse_mode="HTML"
+                ))
+            except TelegramError as e:
+                # доступ є, але користувач не отримав повідомлення (напр. не запускав бота)
+                return (uid, "not_sent", str(e), link)
+
+            return (uid, "ok", "", link)
+
+    rows = list(await asyncio.gather(*(grant_one(uid) for uid in ids)))
+
+    links = [(r[0], r[3], now, product.id) for r in rows if r[3]]
+    if links:
+        async with conn.transaction():
+            await conn.executemany(
+                """
+                INSERT INTO access_links (telegram_id, invite_link, created_at, used, product_id)
+                VALUES (?, ?, ?, 0, ?)
+                """,
+                links
+            )
+
+    rows += [(token, "invalid", "not a telegram id", "") for token in invalid]
+    await send_bulk_report(update, "grant_bulk", rows, bulk_summary("✅ <b>Масова видача доступу</b>", rows, started))
+
+
+async def admin_gift_bulk_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not is_admin(update):
+        return
+
+    ids, invalid = await read_bulk_ids(update, context)
+    product = bulk_product(context)
+    if not ids or not product:
+        await update.message.reply_text(BULK_USAGE, parse_mode="HTML")
+        return
+
+    started = time.monotonic()
+    await update.message.reply_text(f"⏳ Створюю подарунки: <b>{len(ids)}</b>…", parse_mode="HTML")
+
+    conn = await get_db()
+    now = int(time.time())
+    codes = {uid: secrets.token_urlsafe(16) for uid in ids}
+
+    # одна транзакція на всю пачку
+    async with conn.transaction():
+        await conn.executemany(
+            """
+            INSERT INTO gifts (buyer_telegram_id, gift_code, created_at, product_id)
+            VALUES (?, ?, ?, ?)
+            """,
+            [(uid, code, now, product.id) for uid, code in codes.items()]
+        )
+
+    sem = asyncio.Semaphore(BULK_CONCURRENCY)
+
+    async def send_one(uid: int) -> tuple:
+        code = codes[uid]
+        async with sem:
+            try:
+                await with_retry(lambda: telegram_app.bot.send_message(
+                    chat_id=uid,
+                    text=gift_text(product),
+                    reply_markup=gift_keyboard(code),
+                    parse_mode="HTML"
+                ))
+            except TelegramError as e:
+                # подарунок створено — код є у звіті, можна переслати вручну
+                return (uid, "not_sent", str(e), code)
+
+            return (uid, "ok", "", code)
+
+    rows = list(await asyncio.gather(*(send_one(uid) for uid in ids)))
+    rows += [(token, "invalid", "not a telegram id", "") for token in invalid]
+    await send_bulk_report(update, "gift_bulk", rows, bulk_summary("🎁 <b>Масова видача подарунків</b>", rows, started))
+
+
+telegram_app.add_handler(CommandHandler("grant_bulk", admin_grant_bulk_cmd))
+telegram_app.add_handler(CommandHandler("gift_bulk", admin_gift_bulk_cmd))
+
+
+# ===================== PAYMENT REMINDERS =====================
+
+# Кожен етап (затримка з REMINDER_DELAYS) має свій водяний знак
+# (last_activity, telegram_id) у bot_state: за тік читаємо лише тих, хто
+# «дозрів» з минулого разу, тож вартість залежить від кількості нових
+# боржників, а не від розміру users.
+
+REMINDER_TEXTS = [
+    (
+        "👋 Бачу, Ви почали оформлення курсу <b>«{title}»</b>, "
+        "але оплату не завершено.\n\n"
+        "Якщо щось пішло не так — спробуйте ще раз за кнопкою нижче "
+        "або напишіть у підтримку 🙏"
+    ),
+    (
+        "💆‍♀️ Нагадуємо про курс <b>«{title}»</b>.\n\n"
+        "Доступ до відеоуроків відкриється одразу після оплати. "
+        "Якщо маєте питання — ми на зв'язку 💙"
+    ),
+]
+
+
+def reminder_text(stage: int, product: Product) -> str:
+    text = REMINDER_TEXTS[min(stage, len(REMINDER_TEXTS) - 1)]
+    return text.format(title=course_title(product))
+
+
+def reminder_keyboard(product: Product) -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton("💳 Перейти до оплати", url=product.payment_url)],
+        [InlineKeyboardButton("✉️ Написати в підтримку", callback_data="support:menu")]
+    ])
+
+
+async def send_reminder(user_id: int, stage: int, product: Product) -> str:
+    await send_limiter.acquire()
+    try:
+        await with_retry(lambda: telegram_app.bot.send_message(
+            chat_id=user_id,
+            text=reminder_text(stage, product),
+            reply_markup=reminder_keyboard(product),
+            parse_mode="HTML"
+        ))
+        return "sent"
+    except TelegramError as e:
+        # напр. користувач заблокував бота — повторно не пробуємо
+        log.info("Reminder %d to %s failed: %r", stage, user_id, e)
+        return "failed"
+
+
+async def process_reminder_stage(stage: int, delay: int) -> int:
+    conn = await get_db()
+    now = int(time.time())
+    cutoff = now - delay
+    key = f"reminders:{stage}"
+
+    wm = await get_state(key)
+    if wm:
+        wm_ts, wm_id = (int(x) for x in wm.split(":"))
+    else:
+        wm_ts, wm_id = cutoff - REMINDER_CATCHUP_SECONDS, 0
+
+    sent = 0
+    while True:
+        cur = await conn.execute(
+            """
+            SELECT telegram_id, last_activity, awaiting_payment_type, awaiting_product_id
+            FROM users
+            WHERE awaiting_payment = 1
+              AND last_activity <= ?
+              AND (last_activity > ? OR (last_activity = ? AND telegram_id > ?))
+            ORDER BY last_activity, telegram_id
+            LIMIT ?
+            """,
+            (cutoff, wm_ts, wm_ts, wm_id, REMINDER_BATCH)
+        )
+        rows = await cur.fetchall()
+        if not rows:
+            break
+
+        ids = [r["telegram_id"] for r in rows]
+        cur = await conn.execute(
+            f"SELECT telegram_id FROM payment_reminders WHERE stage = ? "
+            f"AND telegram_id IN ({','.join('?' * len(ids))})",
+            (stage, *ids)
+        )
+        already = {r["telegram_id"] for r in await cur.fetchall()}
+
+        cur = await conn.execute(
+            f"SELECT telegram_id, product_id FROM access_grants "
+            f"WHERE telegram_id IN ({','.join('?' * len(ids))})",
+            ids
+        )
+        granted = {(r["telegram_id"], r["product_id"]) for r in await cur.fetchall()}
+
+        due = []
+        for r in rows:
+            product = get_product(r["awaiting_product_id"]) or default_product()
+            if r["telegram_id"] in already:
+                continue
+            # уже купив цей курс собі — нагадувати нема про що
+            if r["awaiting_payment_type"] == "self" and (r["telegram_id"], product.id) in granted:
+                continue
+            due.append((r["telegram_id"], product))
+
+        # спершу фіксуємо намір і водяний знак: після падіння нагадування
+        # краще не надіслати, ніж надіслати двічі
+        wm_ts, wm_id = rows[-1]["last_activity"], rows[-1]["telegram_id"]
+        async with conn.transaction():
+            await conn.executemany(
+                "INSERT OR IGNORE INTO payment_reminders (telegram_id, stage, sent_at, status) "
+                "VALUES (?, ?, ?, 'sending')",
+                [(uid, stage, now) for uid, _ in due]
+            )
+            await put_state(conn, key, f"{wm_ts}:{wm_id}")
+
+        results = await asyncio.gather(*(send_reminder(uid, stage, product) for uid, product in due))
+
+        async with conn.transaction():
+            await conn.executemany(
+                "UPDATE payment_reminders SET status = ?, sent_at = ? WHERE telegram_id = ? AND stage = ?",
+                [(status, int(time.time()), uid, stage) for (uid, _), status in zip(due, results)]
+            )
+
+        sent += results.count("sent")
+        if len(rows) < REMINDER_BATCH:
+            break
+
+    return sent
+
+
+async def payment_reminders_loop():
+    while True:
+        for stage, delay in enumerate(REMINDER_DELAYS):
+            sent = await process_reminder_stage(stage, delay)
+            if sent:
+                log.info("Payment reminders stage %d: sent %d", stage, sent)
+        await asyncio.sleep(REMINDER_INTERVAL)
+
+
+# ===================== DRIP LESSONS =====================
+
+# Після видачі доступу плануємо серію листів у scheduled_jobs (таблиця
+# переживає рестарт). Планувальник тримає в пам'яті лише мін-купу найближчих
+# (due_at, id) — до DRIP_WINDOW секунд уперед і не більше DRIP_HEAP_MAX, —
+# спить до першого due_at і пачками перекладає задачі в outbox, який уже
+# шле їх через send_limiter. Статус задачі і запис в outbox — одна транзакція,
+# тож після рестарту лист не піде вдруге.
+
+DRIP_TEXTS = [
+    (
+        "📚 Як Вам курс <b>«{title}»</b>?\n\n"
+        "Радимо почати з першого уроку вже сьогодні — достатньо 10–15 хвилин на день.\n"
+        "Загубили посилання на канал — надішліть /access 🙏"
+    ),
+    (
+        "💆‍♀️ Нагадуємо про заняття з курсу <b>«{title}»</b>.\n\n"
+        "Регулярність важливіша за тривалість: кілька хвилин щодня "
+        "дають найкращий результат 💙"
+    ),
+    (
+        "🌿 Минув тиждень з курсом <b>«{title}»</b>!\n\n"
+        "Як Ваші відчуття? Якщо є питання щодо технік — напишіть у підтримку, "
+        "ми допоможемо."
+    ),
+]
+
+
+def drip_text(stage: int, product: Product) -> str:
+    text = DRIP_TEXTS[min(stage, len(DRIP_TEXTS) - 1)]
+    return text.format(title=course_title(product))
+
+
+def drip_keyboard() -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton("✉️ Написати в підтримку", callback_data="support:menu")]
+    ])
+
+
+async def schedule_drip(conn, user_ids: list[int], product: Product, start: int):
+    # без commit — у транзакції видачі доступу
+    if not DRIP_DELAYS:
+        return
+    await conn.executemany(
+        """
+        INSERT OR IGNORE INTO scheduled_jobs (kind, telegram_id, product_id, stage, due_at, status, created_at)
+        VALUES ('drip', ?, ?, ?, ?, 'pending', ?)
+        """,
+        [
+            (uid, product.id, stage, start + delay, start)
+            for uid in user_ids
+            for stage, delay in enumerate(DRIP_DELAYS)
+        ]
+    )
+    scheduler.poke(start + min(DRIP_DELAYS))
+
+
+class JobScheduler:
+
+    def __init__(self, window: int, heap_max: int, batch: int):
+        self.window = window
+        self.heap_max = heap_max
+        self.batch = batch
+        self.heap: list[tuple[int, int]] = []
+        # у купі — всі pending-задачі з due_at < horizon (крім уже взятих)
+        self.horizon = 0
+        self.stale = True
+        self._wakeup = asyncio.Event()
+
+    def poke(self, due_at: int):
+        # нова задача потрапляє в уже завантажене вікно — перечитаємо купу
+        if due_at < self.horizon:
+            self.stale = True
+            self._wakeup.set()
+
+    async def load(self):
+        now = int(time.time())
+        # межу і прапорець ставимо до SELECT: poke() під час запиту порівнює
+        # з новою межею і знову позначає купу застарілою, а не губиться
+        self.horizon = now + self.window
+        self.stale = False
+        conn = await get_db()
+        cur = await conn.execute(
+            """
+            SELECT id, due_at FROM scheduled_jobs
+            WHERE status = 'pending' AND due_at < ?
+            ORDER BY due_at, id
+            LIMIT ?
+            """,
+            (now + self.window, self.heap_max)
+        )
+        rows = await cur.fetchall()
+        # відсортований список — уже коректна мін-купа
+        self.heap = [(r["due_at"], r["id"]) for r in rows]
+        if len(rows) == self.heap_max:
+            self.horizon = rows[-1]["due_at"]
+
+    async def dispatch(self, job_ids: list[int]) -> int:
+        conn = await get_db()
+        async with conn.transaction():
+            cur = await conn.execute(
+                f"""
+                SELECT j.id, j.telegram_id, j.product_id, j.stage,
+                       EXISTS (
+                           SELECT 1 FROM access_grants g
+                           WHERE g.telegram_id = j.telegram_id AND g.product_id = j.product_id
+                       ) AS has_access
+                FROM scheduled_jobs j
+                WHERE j.id IN ({",".join("?" * len(job_ids))}) AND j.status = 'pending'
+                """,
+                job_ids
+            )
+            now = int(time.time())
+            results = []
+            for r in await cur.fetchall():
+                product = get_product(r["product_id"])
+                # доступ відкликали або продукт прибрали з каталогу — не пишемо
+                if not r["has_access"] or product is None:
+                    results.append(("cancelled", now, r["id"]))
+                    continue
+                await enqueue_message(conn, r["telegram_id"], drip_text(r["stage"], product), drip_keyboard(), kind="drip")
+                results.append(("done", now, r["id"]))
+
+            await conn.executemany(
+                "UPDATE scheduled_jobs SET status = ?, done_at = ? WHERE id = ?",
+                results
+            )
+        outbox.wake()
+        return sum(1 for status, _, _ in results if status == "done")
+
+    async def run(self):
+        while True:
+            self._wakeup.clear()
+            if self.stale or (not self.heap and time.time() >= self.horizon):
+                await self.load()
+
+            now = time.time()
+            if self.heap and self.heap[0][0] <= now:
+                job_ids = []
+                while self.heap and self.heap[0][0] <= now and len(job_ids) < self.batch:
+                    job_ids.append(heapq.heappop(self.heap)[1])
+                sent = await self.dispatch(job_ids)
+                if sent:
+                    log.info("Drip lessons: queued %d messages", sent)
+                continue
+
+            # спимо до найближчої задачі або до межі вікна; poke() розбудить раніше
+            wake_at = self.heap[0][0] if self.heap else self.horizon
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), max(0.0, wake_at - now))
+            except asyncio.TimeoutError:
+                pass
+
+
+scheduler = JobScheduler(DRIP_WINDOW, DRIP_HEAP_MAX, DRIP_BATCH)
+
+
+# ===================== BACKUPS =====================
+
+# Копія знімається окремим sqlite3-з'єднанням у потоці через VACUUM INTO.
+# БД у WAL-режимі (get_db), тож знімок — це одна транзакція читання:
+# записи бота тим часом ідуть у WAL, копія не перезапускається і файл не
+# блокується. Event loop і з'єднання aiosqlite при цьому не блокуються.
+
+BACKUP_PREFIX = "database-"
+RESTORE_DRAIN_TIMEOUT = 30
+
+backup_lock = asyncio.Lock()
+
+
+def _vacuum_into(src_path: str, dst_path: str):
+    src = sqlite3.connect(src_path, timeout=30)
+    try:
+        src.execute("VACUUM INTO ?", (dst_path,))
+    finally:
+        src.close()
+
+
+def _copy_db(src_path: str, dst_path: str):
+    src = sqlite3.connect(src_path)
+    dst = sqlite3.connect(dst_path, timeout=30)
+    try:
+        src.backup(dst)
+    finally:
+        dst.close()
+        src.close()
+
+
+def _integrity_check(path: str) -> str:
+    conn = sqlite3.connect(path)
+    try:
+        return conn.execute("PRAGMA integrity_check").fetchone()[0]
+    finally:
+        conn.close()
+
+
+def _make_backup(dst_dir: str) -> dict:
+    os.makedirs(dst_dir, exist_ok=True)
+    # кілька бекапів за секунду (страховка в /restore одразу після /backup) —
+    # лічильник у назві; наявний знімок не перезаписуємо ніколи
+    stamp = BACKUP_PREFIX + time.strftime("%Y%m%d-%H%M%S", time.gmtime())
+    name = stamp + ".db"
+    n = 0
+    while os.path.exists(os.path.join(dst_dir, name + ".gz")):
+        n += 1
+        name = f"{stamp}-{n}.db"
+    tmp_path = os.path.join(dst_dir, name + ".tmp")
+    gz_path = os.path.join(dst_dir, name + ".gz")
+    started = time.monotonic()
+
+    try:
+        _vacuum_into(DB_PATH, tmp_path)
+
+        integrity = _integrity_check(tmp_path)
+        if integrity != "ok":
+            raise RuntimeError(f"integrity_check failed: {integrity}")
+
+        with open(tmp_path, "rb") as f_in, gzip.open(gz_path + ".part", "wb", compresslevel=6) as f_out:
+            shutil.copyfileobj(f_in, f_out, 1024 * 1024)
+        # link замість replace: FileExistsError, якщо назва вже зайнята
+        os.link(gz_path + ".part", gz_path)
+        os.remove(gz_path + ".part")
+    finally:
+        for path in (tmp_path, gz_path + ".part"):
+            if os.path.exists(path):
+                os.remove(path)
+
+    return {
+        "name": name + ".gz",
+        "path": gz_path,
+        "size": os.path.getsize(gz_path),
+        "seconds": round(time.monotonic() - started, 2),
+    }
+
+
+def list_backups() -> list[tuple[str, float, int]]:
+    if not os.path.isdir(BACKUP_DIR):
+        return []
+    items = []
+    for name in os.listdir(BACKUP_DIR):
+        if name.startswith(BACKUP_PREFIX) and name.endswith(".db.gz"):
+            st = os.stat(os.path.join(BACKUP_DIR, name))
+            items.append((name, st.st_mtime, st.st_size))
+    return sorted(items, key=lambda x: x[1], reverse=True)
+
+
+def _rotate_backups() -> int:
+    now = time.time()
+    removed = 0
+    # найсвіжіший бекап не видаляємо ніколи
+    for i, (name, mtime, _) in enumerate(list_backups()):
+        if i == 0:
+            continue
+        if i >= BACKUP_KEEP or now - mtime > BACKUP_MAX_AGE_DAYS * 86400:
+            os.remove(os.path.join(BACKUP_DIR, name))
+            removed += 1
+    return removed
+
+
+async def run_backup() -> dict:
+    async with backup_lock:
+        # події з буфера — теж у копію
+        await event_log.flush()
+        result = await asyncio.to_thread(_make_backup, BACKUP_DIR)
+        result["rotated"] = await asyncio.to_thread(_rotate_backups)
+        log.info("Backup %s done: %d bytes in %.2fs", result["name"], result["size"], result["seconds"])
+        return result
+
+
+def _restore_from(gz_path: str):
+    tmp_path = gz_path[:-len(".gz")] + ".restore"
+    try:
+        with gzip.open(gz_path, "rb") as f_in, open(tmp_path, "wb") as f_out:
+            shutil.copyfileobj(f_in, f_out, 1024 * 1024)
+
+        integrity = _integrity_check(tmp_path)
+        if integrity != "ok":
+            raise RuntimeError(f"integrity_check failed: {integrity}")
+
+        # backup API у зворотний бік: сторінки знімка → робоча БД
+        _copy_db(tmp_path, DB_PATH)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+async def wait_updates_drained(own: int, timeout: float) -> bool:
+    deadline = time.monotonic() + timeout
+    while updates_inflight > own:
+        if time.monotonic() >= deadline:
+            return False
+        await asyncio.sleep(0.05)
+    return True
+
+
+async def restore_backup(name: str) -> dict:
+    global db
+    path = os.path.join(BACKUP_DIR, os.path.basename(name))
+    if not os.path.isfile(path):
+        raise FileNotFoundError(name)
+
+    async with backup_lock:
+        # нові апдейти чекають; ті, що вже в роботі, дообробляються на старій БД
+        # (сам /restore — теж апдейт, його не чекаємо)
+        intake_open.clear()
+        try:
+            if not await wait_updates_drained(1 if current_trace.get() else 0, RESTORE_DRAIN_TIMEOUT):
+                raise RuntimeError("updates are still being processed, try again later")
+
+            await supervisor.stop(DB_TASKS)
+            try:
+                await event_log.flush()
+                # страховка: поточний стан теж зберігаємо
+                safety = await asyncio.to_thread(_make_backup, BACKUP_DIR)
+
+                db_ready.clear()
+                try:
+                    if db is not None:
+                        await db.close()
+                        db = None
+                    await asyncio.to_thread(_restore_from, path)
+                finally:
+                    db_ready.set()
+
+                # бекап міг бути знятий зі старішою схемою
+                await init_db()
+                await load_catalog()
+                # купа планувальника — зі старої БД
+                scheduler.heap = []
+                scheduler.horizon = 0
+                scheduler.stale = True
+            finally:
+                start_db_tasks()
+        finally:
+            intake_open.set()
+
+    log.warning("Database restored from %s (previous state saved as %s)", name, safety["name"])
+    return safety
+
+
+async def backup_loop():
+    while True:
+        await asyncio.sleep(BACKUP_INTERVAL_HOURS * 3600)
+        await run_backup()
+
+
+def human_size(size: int) -> str:
+    for unit in ("B", "KB", "MB", "GB"):
+        if size < 1024 or unit == "GB":
+            return f"{size:.0f} {unit}" if unit == "B" else f"{size:.1f} {unit}"
+        size /= 1024
+
+
+async def backup_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not is_admin(update):
+        return
+
+    await update.message.reply_text("⏳ Роблю бекап…", parse_mode="HTML")
+    try:
+        result = await run_backup()
+    except Exception as e:
+        log.exception("Backup failed")
+        await update.message.reply_text(f"❌ Бекап не вдався: <code>{e}</code>", parse_mode="HTML")
+        return
+
+    await update.message.reply_text(
+        "✅ <b>Бекап готовий</b>\n\n"
+        f"📦 <code>{result['name']}</code>\n"
+        f"💾 {human_size(result['size'])} · ⏱ {result['seconds']} с\n"
+        f"🗑 Видалено старих: {result['rotated']}",
+        parse_mode="HTML"
+    )
+
+    # /backup send — ще й надіслати файл у чат (ліміт Bot API — 50 МБ)
+    if context.args and context.args[0] == "send" and result["size"] < 50 * 1024 * 1024:
+        with open(result["path"], "rb") as f:
+            await update.message.reply_document(document=f, filename=result["name"])
+
+
+async def backups_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not is_admin(update):
+        return
+
+    items = list_backups()
+    if not items:
+        await update.message.reply_text("Бекапів ще немає.", parse_mode="HTML")
+        return
+
+    lines = ["<b>Бекапи</b> (нові зверху):\n"]
+    for name, mtime, size in items:
+        lines.append(f"• <code>{name}</code> — {human_size(size)}")
+    lines.append("\nВідновлення: <code>/restore &lt;файл&gt; confirm</code>")
+    await update.message.reply_text("\n".join(lines), parse_mode="HTML")
+
+
+async def restore_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not is_admin(update):
+        return
+
+    args = context.args or []
+    if len(args) != 2 or args[1] != "confirm":
+        await update.message.reply_text(
+            "⚠️ Відновлення замінить поточну базу.\n\n"
+            "Використання: <code>/restore &lt;файл&gt; confirm</code>\n"
+            "Список файлів: /backups",
+            parse_mode="HTML"
+        )
+        return
+
+    try:
+        safety = await restore_backup(args[0])
+    except FileNotFoundError:
+        await update.message.reply_text("❌ Немає такого бекапу. Див. /backups", parse_mode="HTML")
+        return
+    except Exception as e:
+        log.exception("Restore failed")
+        await update.message.reply_text(f"❌ Відновлення не вдалося: <code>{e}</code>", parse_mode="HTML")
+        return
+
+    await update.message.reply_text(
+        f"✅ Базу відновлено з <code>{args[0]}</code>\n"
+        f"Попередній стан збережено як <code>{safety['name']}</code>",
+        parse_mode="HTML"
+    )
+
+
+telegram_app.add_handler(CommandHandler("backup", backup_cmd))
+telegram_app.add_handler(CommandHandler("backups", backups_cmd))
+telegram_app.add_handler(CommandHandler("restore", restore_cmd))
+
+
 # ===================== PAYMENT SUCCESS PAGE =====================
 
 @app.get("/payment/success", response_class=HTMLResponse)
-async def payment_success():
+async def payment_success(product: int | None = None):
+    # ?product=<id> у return URL платіжної сторінки → start=paid_<id>
+    start_param = f"paid_{product}" if product is not None and product in catalog.products else "paid"
+
     return f"""
 <!DOCTYPE html>
 <html lang="uk">
@@ -985,7 +3802,7 @@ async def payment_success():
             Дякуємо за оплату!<br>
             Натисніть кнопку нижче, щоб отримати доступ до курсу.
         </p>
-        <a class="button" href="https://t.me/{BOT_USERNAME}?start=paid">Отримати доступ</a>
+        <a class="button" href="https://t.me/{BOT_USERNAME}?start={start_param}">Отримати доступ</a>
         <div class="hint">
             Якщо кнопка не відкрилась — відкрийте Telegram<br>
             та напишіть боту <b>@{BOT_USERNAME}</b>
@@ -996,6 +3813,37 @@ async def payment_success():
 """
 
 
+# ===================== HEALTH =====================
+
+async def db_ping(timeout: float = 2.0) -> dict:
+    t0 = time.perf_counter()
+    try:
+        conn = await get_db()
+        await asyncio.wait_for(conn.execute("SELECT 1"), timeout)
+        ok = True
+    except Exception as e:
+        log.warning("DB health check failed: %r", e)
+        ok = False
+    return {"ok": ok, "ms": round((time.perf_counter() - t0) * 1000, 2)}
+
+
+@app.get("/health")
+async def health():
+    db_status = await db_ping()
+    ok = db_status["ok"] and supervisor.healthy()
+
+    return JSONResponse(
+        status_code=200 if ok else 503,
+        content={
+            "status": "ok" if ok else "degraded",
+            "loop_lag": loop_monitor.status(),
+            "tasks": supervisor.status(),
+            "db": db_status,
+            "queues": {name: depth() for name, depth in QUEUE_DEPTHS.items()},
+        }
+    )
+
+
 # ===================== ROOT =====================
 
 @app.get("/")
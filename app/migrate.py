@@ -0,0 +1,117 @@
+# Міграції схеми без запуску бота.
+#
+#   python app/migrate.py database.db              # застосувати до БД
+#   python app/migrate.py database.db --dry-run    # на копії: що зміниться і скільки триватиме
+#
+# --dry-run знімає онлайн-копію через SQLite backup API (бот може далі
+# працювати), застосовує до неї міграції, друкує звіт і видаляє копію.
+# Запускайте з тими ж ENV, що й бот: міграції читають, напр., PRODUCT_ID.
+
+import os
+import sys
+import time
+import sqlite3
+import asyncio
+import argparse
+import tempfile
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Apply or time DB schema migrations")
+    parser.add_argument("db", help="шлях до database.db")
+    parser.add_argument("--dry-run", action="store_true",
+                        help="застосувати до тимчасової копії і показати звіт")
+    return parser.parse_args()
+
+
+def configure_env(db_path: str):
+    os.environ["DB_PATH"] = db_path
+    os.environ["RECORD_DIR"] = ""
+    # main.py перевіряє ENV при імпорті; для міграцій ці значення не потрібні
+    defaults = {
+        "BOT_TOKEN": "123456:migrate",
+        "WEBHOOK_TOKEN": "migrate",
+        "CHANNEL_ID": "-1",
+        "ADMIN_ID": "1",
+        "SUPPORT_CHAT_ID": "-1",
+        "PAYMENT_BUTTON_URL": "https://example.com/pay",
+        "KEEP_ALIVE_URL": "http://127.0.0.1/",
+        "BOT_USERNAME": "migrate_bot",
+        "LOG_LEVEL": "WARNING",
+    }
+    for key, value in defaults.items():
+        os.environ.setdefault(key, value)
+
+
+def copy_db(src_path: str, dst_path: str):
+    src = sqlite3.connect(src_path)
+    dst = sqlite3.connect(dst_path)
+    try:
+        src.backup(dst)
+    finally:
+        dst.close()
+        src.close()
+
+
+def schema_objects(path: str) -> set[tuple[str, str]]:
+    conn = sqlite3.connect(path)
+    try:
+        return set(conn.execute("SELECT type, name FROM sqlite_master WHERE name NOT LIKE 'sqlite_%'"))
+    finally:
+        conn.close()
+
+
+async def run(db_path: str) -> tuple[int, list[tuple[int, str, float]]]:
+    import main
+
+    conn = await main.get_db()
+    try:
+        before = await main.schema_version(conn)
+        applied = await main.migrate(conn)
+    finally:
+        await conn.close()
+    return before, applied
+
+
+def main_cli():
+    args = parse_args()
+    if not os.path.exists(args.db):
+        sys.exit(f"{args.db}: not found")
+
+    scratch = None
+    target = args.db
+    if args.dry_run:
+        scratch = tempfile.mkdtemp(prefix="migrate-")
+        target = os.path.join(scratch, os.path.basename(args.db))
+        t0 = time.perf_counter()
+        copy_db(args.db, target)
+        print(f"copy:      {os.path.getsize(target) / 1024 / 1024:.1f} MB in {time.perf_counter() - t0:.2f}s")
+
+    try:
+        configure_env(target)
+        objects_before = schema_objects(target)
+        before, applied = asyncio.run(run(target))
+
+        import main
+        print(f"version:   {before} → {applied[-1][0] if applied else before} (code: {main.SCHEMA_VERSION})")
+        for version, name, seconds in applied:
+            print(f"  {version:>3}  {name:<45} {seconds * 1000:10.1f} ms")
+        if not applied:
+            print("  up to date")
+        else:
+            print(f"total:     {sum(s for _, _, s in applied) * 1000:.1f} ms")
+
+        created = sorted(schema_objects(target) - objects_before)
+        for kind, name in created:
+            print(f"  + {kind} {name}")
+        if args.dry_run:
+            print("dry run:   the original database was not modified")
+    finally:
+        if scratch:
+            for name in os.listdir(scratch):
+                os.remove(os.path.join(scratch, name))
+            os.rmdir(scratch)
+
+
+if __name__ == "__main__":
+    main_cli()
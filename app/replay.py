@@ -0,0 +1,269 @@
+# Відтворення запису webhook-трафіку (RECORD_DIR у main.py) проти фейкового
+# Bot API і тимчасової БД. Бойові БД і токен не використовуються.
+#
+#   python app/replay.py records/updates-*.jsonl.gz             # як у запису
+#   python app/replay.py records/updates-*.jsonl.gz --speed 10  # у 10 разів швидше
+#   python app/replay.py records/updates-*.jsonl.gz --speed 0   # максимально швидко
+#
+# Апдейти одного користувача йдуть строго по черзі (як і в проді), різних —
+# паралельно, тож стан у БД після прогону відтворюваний.
+
+import os
+import sys
+import gzip
+import json
+import time
+import random
+import shutil
+import asyncio
+import argparse
+import itertools
+import tempfile
+from collections import Counter
+
+import httpx
+from aiohttp import web
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Replay recorded webhook traffic")
+    parser.add_argument("files", nargs="+", help="updates-*.jsonl.gz")
+    parser.add_argument("--speed", type=float, default=1.0,
+                        help="1 — як у запису, 2 — вдвічі швидше, 0 — без пауз")
+    parser.add_argument("--concurrency", type=int, default=64,
+                        help="скільки апдейтів обробляються одночасно")
+    parser.add_argument("--db", default=None,
+                        help="scratch-БД (за замовчуванням — тимчасовий файл)")
+    parser.add_argument("--api-port", type=int, default=8089)
+    parser.add_argument("--api-latency", type=float, default=0.0,
+                        help="затримка відповіді фейкового Bot API, мс")
+    parser.add_argument("--limit", type=int, default=0, help="відтворити лише перші N апдейтів")
+    parser.add_argument("--seed", type=int, default=0)
+    return parser.parse_args()
+
+
+def configure_env(args, db_path: str, scratch: str):
+    # усе, що може зачепити прод, — примусово; /backup і /restore з запису
+    # працюють лише з бекапами в scratch-каталозі
+    os.environ.update({
+        "DB_PATH": db_path,
+        "BACKUP_DIR": os.path.join(scratch, "backups"),
+        "TELEGRAM_API_URL": f"http://127.0.0.1:{args.api_port}/bot",
+        "KEEP_ALIVE_URL": f"http://127.0.0.1:{args.api_port}/ping",
+        "INGESTION_MODE": "webhook",
+        "RECORD_DIR": "",
+        "BACKUP_INTERVAL_HOURS": "0",
+        "WEBHOOK_BASE_URL": "",
+        "WEBHOOK_SECRET": "",
+    })
+    # решта — лише якщо не задано (ADMIN_ID варто взяти з проду,
+    # щоб адмінські команди з запису пройшли перевірку)
+    defaults = {
+        "BOT_TOKEN": "123456:replay",
+        "WEBHOOK_TOKEN": "replay",
+        "CHANNEL_ID": "-1000000000001",
+        "ADMIN_ID": "1",
+        "SUPPORT_CHAT_ID": "-1000000000002",
+        "PAYMENT_BUTTON_URL": "https://example.com/pay",
+        "BOT_USERNAME": "replay_bot",
+        "TRACE_SAMPLE_RATE": "0",
+        "LOG_LEVEL": "WARNING",
+    }
+    for key, value in defaults.items():
+        os.environ.setdefault(key, value)
+
+
+def load_recording(paths: list[str], limit: int = 0) -> list[tuple[float, dict]]:
+    items = []
+    for path in paths:
+        try:
+            with gzip.open(path, "rt", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        rec = json.loads(line)
+                    except ValueError:
+                        continue
+                    items.append((rec["ts"], rec["update"]))
+        except (EOFError, OSError) as e:
+            # обірваний останній gzip-member — беремо те, що встигли прочитати
+            print(f"{path}: truncated ({e!r})", file=sys.stderr)
+
+    items.sort(key=lambda item: (item[0], item[1].get("update_id", 0)))
+    return items[:limit] if limit else items
+
+
+def update_user_id(update: dict) -> int | None:
+    for value in update.values():
+        if isinstance(value, dict) and isinstance(value.get("from"), dict):
+            return value["from"].get("id")
+    return None
+
+
+class FakeBotAPI:
+    # Відповідає на методи, які викликає бот, правдоподібними об'єктами
+
+    BOT = {"id": 1, "is_bot": True, "first_name": "Replay", "username": "replay_bot"}
+
+    def __init__(self, latency_ms: float):
+        self.latency = latency_ms / 1000
+        self.calls = Counter()
+        self._ids = itertools.count(1)
+
+    def message(self, chat_id: int, text: str = "") -> dict:
+        return {
+            "message_id": next(self._ids),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private" if chat_id > 0 else "supergroup"},
+            "text": text,
+        }
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        self.calls[method] += 1
+        data = dict(await request.post())
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        try:
+            chat_id = int(data.get("chat_id", 1))
+        except ValueError:
+            chat_id = 1
+
+        if method == "getMe":
+            result = self.BOT
+        elif method in ("sendMessage", "sendDocument", "sendPhoto", "editMessageText"):
+            result = self.message(chat_id, data.get("text", ""))
+        elif method == "sendMediaGroup":
+            result = [self.message(chat_id)]
+        elif method == "copyMessage":
+            result = {"message_id": next(self._ids)}
+        elif method == "createChatInviteLink":
+            result = {
+                "invite_link": f"https://t.me/+replay{next(self._ids)}",
+                "creator": self.BOT,
+                "creates_join_request": False,
+                "is_primary": False,
+                "is_revoked": False,
+            }
+        elif method == "getUpdates":
+            result = []
+        elif method == "getWebhookInfo":
+            result = {"url": "", "has_custom_certificate": False, "pending_update_count": 0}
+        else:
+            result = True
+        return web.json_response({"ok": True, "result": result})
+
+    async def start(self, port: int) -> web.AppRunner:
+        app = web.Application()
+        app.router.add_post("/bot{token}/{method}", self.handle)
+        app.router.add_get("/ping", lambda request: web.Response(text="ok"))
+        runner = web.AppRunner(app)
+        await runner.setup()
+        await web.TCPSite(runner, "127.0.0.1", port).start()
+        return runner
+
+
+def percentile(sorted_values: list[float], q: float) -> float:
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(q * len(sorted_values)))]
+
+
+async def drain_outbox(main, timeout: float = 30.0):
+    # повідомлення з outbox — теж частина навантаження на Bot API
+    conn = await main.get_db()
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        cur = await conn.execute(
+            "SELECT COUNT(*) FROM outbox WHERE status IN ('pending', 'sending') AND next_attempt_at <= ?",
+            (int(time.time()),)
+        )
+        if (await cur.fetchone())[0] == 0:
+            return
+        main.outbox.wake()
+        await asyncio.sleep(0.1)
+
+
+async def replay(args, items: list[tuple[float, dict]]):
+    import main
+
+    random.seed(args.seed)
+    fake = FakeBotAPI(args.api_latency)
+    runner = await fake.start(args.api_port)
+    await main.app.router.startup()
+
+    client = httpx.AsyncClient(
+        transport=httpx.ASGITransport(app=main.app, raise_app_exceptions=False),
+        base_url="http://replay",
+        timeout=None,
+    )
+    path = f"/telegram/webhook/{main.WEBHOOK_TOKEN}"
+    semaphore = asyncio.Semaphore(args.concurrency)
+    latencies: list[float] = []
+    errors = Counter()
+
+    async def send(update: dict, previous: asyncio.Task | None):
+        if previous is not None:
+            await previous
+        async with semaphore:
+            t0 = time.perf_counter()
+            try:
+                r = await client.post(path, json=update)
+                status = r.status_code
+            except Exception as e:
+                status = type(e).__name__
+            latencies.append((time.perf_counter() - t0) * 1000)
+        if status != 200:
+            errors[status] += 1
+
+    chains: dict[int | None, asyncio.Task] = {}
+    first_ts = items[0][0]
+    started = time.monotonic()
+
+    for ts, update in items:
+        if args.speed > 0:
+            delay = started + (ts - first_ts) / args.speed - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        user_id = update_user_id(update)
+        chains[user_id] = asyncio.create_task(send(update, chains.get(user_id)))
+
+    await asyncio.gather(*chains.values())
+    wall = time.monotonic() - started
+    await drain_outbox(main)
+
+    await client.aclose()
+    await main.app.router.shutdown()
+    await runner.cleanup()
+
+    latencies.sort()
+    print(f"updates:     {len(items)} ({len(chains)} users), errors: {dict(errors) or 0}")
+    print(f"wall:        {wall:.2f} s, throughput: {len(items) / wall if wall else 0:.1f} upd/s")
+    print(
+        "latency ms:  "
+        f"p50 {percentile(latencies, 0.50):.1f}, "
+        f"p95 {percentile(latencies, 0.95):.1f}, "
+        f"p99 {percentile(latencies, 0.99):.1f}, "
+        f"max {latencies[-1] if latencies else 0:.1f}"
+    )
+    print("bot api:     " + ", ".join(f"{m}={n}" for m, n in fake.calls.most_common()))
+
+
+def main_cli():
+    args = parse_args()
+    items = load_recording(args.files, args.limit)
+    if not items:
+        sys.exit("No updates in recording")
+
+    scratch = tempfile.mkdtemp(prefix="replay-")
+    db_path = args.db or os.path.join(scratch, "replay.db")
+    configure_env(args, db_path, scratch)
+
+    try:
+        asyncio.run(replay(args, items))
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main_cli()